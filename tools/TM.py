@@ -1,11 +1,14 @@
 from __future__ import annotations
 
-import mimetypes
 import os
-import re
 import shutil
 import tempfile
+import time
+import zipfile
+from collections import deque
 from collections.abc import Generator
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import itemgetter
 from pathlib import Path
 from typing import Any
 
@@ -13,103 +16,218 @@ from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
 
+_PLUGIN_ROOT = Path(__file__).resolve().parent.parent
+_DEFAULT_SKILLS_DIR = _PLUGIN_ROOT / "skills"
+_ENSURED_DIRS: set[Path] = set()
+
+
 def get_skills_dir(explicit_path: str | None = None) -> Path:
-    if explicit_path:
-        p = Path(explicit_path)
-        if p.is_dir():
-            return p
+    if explicit_path and os.path.isdir(explicit_path):
+        return Path(explicit_path)
 
     env_path = os.getenv("SKILLS_ROOT")
     if env_path and os.path.isdir(env_path):
         return Path(env_path)
 
-    root = Path(__file__).resolve().parent.parent
-    skills_dir = root / "skills"
-    skills_dir.mkdir(parents=True, exist_ok=True)
+    skills_dir = _DEFAULT_SKILLS_DIR
+    if skills_dir not in _ENSURED_DIRS:
+        skills_dir.mkdir(parents=True, exist_ok=True)
+        _ENSURED_DIRS.add(skills_dir)
     return skills_dir
 
 
-def list_skills_sorted(root_path: str | None = None) -> list[Path]:
-    skills_dir = get_skills_dir(root_path)
-    if not skills_dir.exists():
+# skills_dir -> (st_mtime_ns, cached_at, sorted folders)
+_LIST_CACHE: dict[Path, tuple[int, float, list[Path]]] = {}
+_LIST_CACHE_TTL = 2.0
+
+_ARCHIVE_SPOOL_MAX_SIZE = 64 << 20
+_ARCHIVE_PARALLEL_MIN_FILES = 32
+_ARCHIVE_READ_WORKERS = 4
+_ARCHIVE_PREFETCH_MAX_FILE_SIZE = 8 << 20
+_ZIP_MIME_TYPE = "application/zip"
+
+_VIEW_COMMANDS = frozenset({"查看技能", "查看 技能", "查看"})
+_ADD_COMMANDS = frozenset({"新增技能", "存入技能", "保存技能"})
+_DELETE_PREFIX = "删除技能"
+_DOWNLOAD_PREFIX = "下载技能"
+
+
+def _parse_indexed_command(command: str, prefix: str) -> int | None:
+    if not command.startswith(prefix):
+        return None
+    rest = command[len(prefix) :]
+    if not rest.isdecimal():
+        return None
+    return int(rest)
+
+
+def invalidate_skills_cache(skills_dir: Path | None = None) -> None:
+    if skills_dir is None:
+        _LIST_CACHE.clear()
+        return
+    _LIST_CACHE.pop(skills_dir, None)
+
+
+def list_skills_sorted(root_path: str | Path | None = None) -> list[Path]:
+    skills_dir = root_path if isinstance(root_path, Path) else get_skills_dir(root_path)
+    try:
+        mtime_ns = skills_dir.stat().st_mtime_ns
+    except OSError:
+        _LIST_CACHE.pop(skills_dir, None)
         return []
-    folders = [p for p in skills_dir.iterdir() if p.is_dir()]
-    folders.sort(key=lambda p: p.stat().st_ctime)
-    return folders
+    now = time.monotonic()
+    cached = _LIST_CACHE.get(skills_dir)
+    if cached and cached[0] == mtime_ns and now - cached[1] < _LIST_CACHE_TTL:
+        return list(cached[2])
+    with os.scandir(skills_dir) as it:
+        entries = [(e.stat().st_ctime_ns, e.name) for e in it if e.is_dir()]
+    entries.sort(key=itemgetter(0))
+    folders = [skills_dir / name for _, name in entries]
+    _LIST_CACHE[skills_dir] = (mtime_ns, now, folders)
+    return list(folders)
+
+
+def _format_skill_list(skills: list[Path]) -> str:
+    return "\n".join(f"{i}. {p.name}" for i, p in enumerate(skills, 1))
+
+
+def _parse_compress_level(value: Any) -> int:
+    try:
+        level = int(value)
+    except (TypeError, ValueError):
+        return 0
+    return min(max(level, 0), 9)
+
+
+def _read_archive_member(path: str) -> bytes | None:
+    try:
+        if os.path.getsize(path) > _ARCHIVE_PREFETCH_MAX_FILE_SIZE:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_archive_member(zf: zipfile.ZipFile, full: str, arcname: str, data: bytes | None) -> None:
+    if data is None:
+        zf.write(full, arcname)
+        return
+    zinfo = zipfile.ZipInfo.from_file(full, arcname)
+    zf.writestr(zinfo, data, compress_type=zf.compression, compresslevel=zf.compresslevel)
+
+
+def _write_skill_zip(dest: Any, target: Path, compress_level: int = 0) -> None:
+    # Skill folders are mostly small text files plus already-compressed assets,
+    # so store by default and only deflate when explicitly asked to.
+    if compress_level <= 0:
+        zf = zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_STORED)
+    else:
+        zf = zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compress_level)
+    base = target.parent
+    members: list[tuple[str, str, bool]] = []
+    for root, dirs, files in os.walk(target):
+        dirs.sort()
+        arc_root = os.path.relpath(root, base)
+        members.append((root, arc_root, False))
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            if os.path.isfile(full):
+                members.append((full, os.path.join(arc_root, name), True))
+
+    with zf:
+        file_count = sum(1 for _, _, is_file in members if is_file)
+        if file_count < _ARCHIVE_PARALLEL_MIN_FILES:
+            for full, arcname, _ in members:
+                zf.write(full, arcname)
+            return
+        # Read files on a small pool while this thread appends entries in walk
+        # order; the window bounds how many file bodies are held in memory.
+        window = _ARCHIVE_READ_WORKERS * 2
+        pending: deque[tuple[str, str, Future[bytes | None] | None]] = deque()
+        with ThreadPoolExecutor(max_workers=_ARCHIVE_READ_WORKERS) as pool:
+            for full, arcname, is_file in members:
+                fut = pool.submit(_read_archive_member, full) if is_file else None
+                pending.append((full, arcname, fut))
+                while len(pending) > window:
+                    p_full, p_arc, p_fut = pending.popleft()
+                    _write_archive_member(zf, p_full, p_arc, p_fut.result() if p_fut else None)
+            while pending:
+                p_full, p_arc, p_fut = pending.popleft()
+                _write_archive_member(zf, p_full, p_arc, p_fut.result() if p_fut else None)
+
+
+def build_skill_archive(target: Path, compress_level: int = 0) -> bytes:
+    # Small archives never leave memory; large ones spill to an anonymous temp file.
+    with tempfile.SpooledTemporaryFile(max_size=_ARCHIVE_SPOOL_MAX_SIZE) as tmp:
+        _write_skill_zip(tmp, target, compress_level)
+        tmp.seek(0)
+        return tmp.read()
 
 
 class TMTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         command = str(tool_parameters.get("command", "")).strip()
         skills_root = str(tool_parameters.get("skills_root") or "").strip() or None
+        compress_level = _parse_compress_level(tool_parameters.get("compress_level"))
+        skills_dir = get_skills_dir(skills_root)
 
-        if command in ("查看技能", "查看 技能", "查看"):
-            skills = list_skills_sorted(skills_root)
+        if command in _VIEW_COMMANDS:
+            skills = list_skills_sorted(skills_dir)
             if not skills:
-                yield self.create_text_message(f"❌当前目录（{get_skills_dir(skills_root)}）下没有已存入的技能包。\n")
+                yield self.create_text_message(f"❌当前目录（{skills_dir}）下没有已存入的技能包。\n")
                 return
-            lines = [f"{idx + 1}. {p.name}" for idx, p in enumerate(skills)]
-            yield self.create_text_message(f"📂技能目录：{get_skills_dir(skills_root)}\n" + "\n".join(lines))
+            yield self.create_text_message(f"📂技能目录：{skills_dir}\n" + _format_skill_list(skills))
             return
 
-        if command in ("新增技能", "存入技能", "保存技能"):
+        if command in _ADD_COMMANDS:
             yield self.create_text_message(
                 "⚠️注意：本插件已配置为使用本地挂载的技能目录。\n"
-                f"当前目录：{get_skills_dir(skills_root)}\n"
+                f"当前目录：{skills_dir}\n"
                 "请直接在文件系统中将技能文件夹放入该目录即可，无需通过此工具导入 ZIP 包。\n"
             )
             return
 
-        m_del = re.match(r"^删除技能(\d+)$", command)
-        if m_del:
-            idx = int(m_del.group(1))
-            skills = list_skills_sorted(skills_root)
+        idx = _parse_indexed_command(command, _DELETE_PREFIX)
+        if idx is not None:
+            skills = list_skills_sorted(skills_dir)
             if idx < 1 or idx > len(skills):
                 yield self.create_text_message("❌技能序号无效或超出范围。请先使用“查看技能”确认序号。\n")
                 return
             target = skills[idx - 1]
             try:
-                shutil.rmtree(target, ignore_errors=False)
+                shutil.rmtree(target)
             except Exception as e:
                 yield self.create_text_message(f"❌删除失败：{e}\n")
                 return
-            yield self.create_text_message(f"✅已删除技能{idx}：{target.name}\n")
-            skills = list_skills_sorted(skills_root)
+            invalidate_skills_cache(skills_dir)
+            deleted_text = f"✅已删除技能{idx}：{target.name}\n"
+            skills = list_skills_sorted(skills_dir)
             if not skills:
-                yield self.create_text_message("😑当前技能列表为空。\n")
+                yield self.create_text_message(deleted_text + "😑当前技能列表为空。\n")
             else:
-                lines = [f"{i + 1}. {p.name}" for i, p in enumerate(skills)]
-                yield self.create_text_message("👓当前技能列表：\n" + "\n".join(lines))
+                yield self.create_text_message(deleted_text + "👓当前技能列表：\n" + _format_skill_list(skills))
             return
 
-        m_dl = re.match(r"^下载技能(\d+)$", command)
-        if m_dl:
-            idx = int(m_dl.group(1))
-            skills = list_skills_sorted(skills_root)
+        idx = _parse_indexed_command(command, _DOWNLOAD_PREFIX)
+        if idx is not None:
+            skills = list_skills_sorted(skills_dir)
             if idx < 1 or idx > len(skills):
                 yield self.create_text_message("❌技能序号无效或超出范围。请先使用“查看技能”确认序号。\n")
                 return
             target = skills[idx - 1]
 
             try:
-                with tempfile.TemporaryDirectory(prefix="skill-zip-") as td:
-                    tmp_dir = Path(td)
-                    zip_path = tmp_dir / f"{target.name}.zip"
-                    shutil.make_archive(str(zip_path.with_suffix("")), "zip", root_dir=target.parent, base_dir=target.name)
-                    blob = zip_path.read_bytes()
+                blob = build_skill_archive(target, compress_level)
             except Exception as e:
                 yield self.create_text_message(f"❌读取文件失败：{e}\n")
                 return
 
-            mime_type, _ = mimetypes.guess_type(f"{target.name}.zip")
-            if not mime_type:
-                mime_type = "application/zip"
-
             yield self.create_text_message(f"⬇️开始下载技能{idx}：{target.name}.zip\n")
             yield self.create_blob_message(
                 blob=blob,
                 meta={
-                    "mime_type": mime_type,
+                    "mime_type": _ZIP_MIME_TYPE,
                     "filename": f"{target.name}.zip",
                 },
             )
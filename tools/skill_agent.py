@@ -1,41 +1,64 @@
 import re
-import json
+import mimetypes
 import os
+import stat
 import time
 import uuid
-import base64
+import weakref
+import functools
+import itertools
 import hashlib
-from collections.abc import Generator
+import inspect
+from collections import OrderedDict, deque
+from collections.abc import Callable, Generator, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any
 
 from utils.tools import (
     _build_prompt_message_tools,
-    _download_file_content,
+    _content_digest,
+    _decode_base64_to_file,
+    _download_files,
+    _elide_tool_result,
     _extract_first_json_object,
     _extract_url_and_name,
+    _format_tool_result,
+    _has_any_file,
     _guess_mime_type,
     _infer_ext_from_url,
     _is_allow_reply,
     _is_deny_reply,
-    _list_dir,
+    _json_dumps,
+    _json_loads,
+    _JsonSniffer,
+    _list_file_paths,
     _parse_tool_call,
+    _pick_accessor,
     _safe_filename,
     _safe_get,
     _safe_join,
+    _safe_join_cached,
     _shorten_text,
     _split_message_content,
+    _truncate_tool_result,
  )
 
-from utils.skill_agent_constants import HISTORY_TRANSCRIPT_MAX_CHARS
-from utils.skill_agent_debug import _dbg, _model_brief
-from utils.skill_agent_exec import _cleanup_old_temp_sessions, _detect_skills_root
+from utils.skill_agent_constants import (
+    EXPORT_FILES_MAX,
+    HISTORY_TRANSCRIPT_MAX_CHARS,
+    TOOL_RESULT_DEFAULT_MAX_CHARS,
+    TOOL_RESULT_ELIDE_AFTER_STEPS,
+    TOOL_RESULT_ELIDE_MIN_CHARS,
+    TOOL_RESULT_MAX_CHARS,
+    TOOL_RESULT_MAX_ENTRIES,
+)
+from utils.skill_agent_debug import _DEBUG_ENABLED, _dbg, _model_brief
+from utils.skill_agent_exec import _cleanup_old_temp_sessions_in_background, _detect_skills_root
 from utils.skill_agent_runtime import _AgentRuntime
 from utils.skill_agent_schemas import TOOL_SCHEMAS, _tool_call_retry_prompt, _validate_tool_arguments
 from utils.skill_agent_storage import (
     _append_history_turn,
-    _get_history_storage_key,
-    _get_resume_storage_key,
-    _get_session_dir_storage_key,
+    _get_session_storage_keys,
     _storage_get_json,
     _storage_get_text,
     _storage_set_json,
@@ -53,6 +76,293 @@ from dify_plugin.entities.model.message import (
 )
 from dify_plugin.entities.tool import ToolInvokeMessage
 
+# TOOL_SCHEMAS is a constant, so the SDK tool objects are built once per process.
+PROMPT_MESSAGE_TOOLS: list[PromptMessageTool] = _build_prompt_message_tools(TOOL_SCHEMAS, PromptMessageTool)
+
+_STREAM_FLUSH_CHARS = 64
+_WINDOWS_PATH_RE = re.compile(r"[A-Za-z]:\\[^\s\r\n\t\"']+")
+_POSIX_PATH_RE = re.compile(r"/[^\s\r\n\t\"']+")
+# SKILL.md is the procedure the model keeps following, so it is never elided.
+_UNELIDED_TOOLS = frozenset({"get_skill_metadata"})
+_LLM_ASSET_TYPES = frozenset({"image", "document", "audio", "video"})
+_LLM_ASSET_EXT_BY_MIME = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "application/pdf": ".pdf",
+    "application/json": ".json",
+    "text/plain": ".txt",
+    "text/markdown": ".txt",
+}
+
+
+def _read_export_bytes(path: str) -> bytes:
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+# Digests of earlier same-name exports, keyed by their stat stamp; resumed
+# sessions compare against the same deliverables again.
+@functools.lru_cache(maxsize=512)
+def _export_digest(path: str, stamp: tuple[int, int, int, int]) -> str:
+    with open(path, "rb") as fp:
+        return hashlib.file_digest(fp, _content_digest).hexdigest()
+
+
+_EXPORT_READ_AHEAD = 4
+# Only files up to this size are read ahead, so at most _EXPORT_READ_AHEAD of
+# them wait in memory besides the one being sent; larger ones are read inline.
+_EXPORT_PREFETCH_MAX_FILE_SIZE = 4 * 1024 * 1024
+
+
+def _read_export_files(files: list[tuple[str, os.stat_result]]) -> Iterator[bytes | None]:
+    # Small files are read up to _EXPORT_READ_AHEAD entries ahead of the consumer
+    # on worker threads; contents still come out in input order, None for
+    # unreadable files.
+    prefetch = sum(1 for _, st in files if st.st_size <= _EXPORT_PREFETCH_MAX_FILE_SIZE)
+    if prefetch < 2:
+        for path, _ in files:
+            try:
+                content = _read_export_bytes(path)
+            except Exception:
+                content = None
+            yield content
+        return
+    with ThreadPoolExecutor(max_workers=_EXPORT_READ_AHEAD) as pool:
+
+        def submit(entry: tuple[str, os.stat_result]) -> tuple[str, Future[bytes] | None]:
+            path, st = entry
+            if st.st_size <= _EXPORT_PREFETCH_MAX_FILE_SIZE:
+                return path, pool.submit(_read_export_bytes, path)
+            return path, None
+
+        pending = iter(files)
+        window = deque(submit(entry) for entry in itertools.islice(pending, _EXPORT_READ_AHEAD))
+        while window:
+            path, future = window.popleft()
+            nxt = next(pending, None)
+            if nxt is not None:
+                window.append(submit(nxt))
+            try:
+                content = future.result() if future is not None else _read_export_bytes(path)
+            except Exception:
+                content = None
+            yield content
+
+
+_TOOL_PROGRESS_TEMPLATES = {
+    "get_skill_metadata": "✅正在查看技能《{skill_name}》说明书…\n",
+    "list_skill_files": "✅正在查看技能《{skill_name}》文件结构…\n",
+    "read_skill_file": "✅正在读取技能《{skill_name}》文件：{relative_path}…\n",
+    "run_skill_command": "✅正在执行技能《{skill_name}》命令…\n",
+    "write_temp_file": "✅正在按说明书写入临时文件：{relative_path}…\n",
+    "copy_temp_file": "✅正在复制临时文件：{source_relative_path} → {relative_path}…\n",
+    "read_temp_file": "✅正在读取临时文件：{relative_path}…\n",
+    "export_temp_file": "✅正在标记交付文件：{temp_relative_path}…\n",
+}
+# Progress lines with no argument are returned as-is rather than formatted.
+_TOOL_PROGRESS_STATIC = {
+    "list_temp_files": "✅正在查看临时目录文件…\n",
+    "run_temp_command": "✅正在执行临时命令…\n",
+}
+_EMPTY_RESPONSE_NUDGE = (
+    '你刚才没有输出任何内容。请继续完成任务：如果支持函数调用请调用工具；否则请输出 JSON：{"type":"final","content":"..."}'
+)
+_COMMAND_TOOLS = frozenset({"run_skill_command", "run_temp_command"})
+# Tools that require the skill's SKILL.md to have been read first.
+_SKILL_GATED_TOOLS = frozenset({"list_skill_files", "read_skill_file", "run_skill_command"})
+
+
+# LLM client class -> whether its invoke() signature accepts tools=, or None when
+# it cannot be told from the signature; older SDKs lack the parameter.
+_LLM_SUPPORTS_TOOLS: weakref.WeakKeyDictionary[type, bool | None] = weakref.WeakKeyDictionary()
+
+
+def _invoke_accepts_tools(llm: Any) -> bool | None:
+    try:
+        params = inspect.signature(llm.invoke).parameters
+    except (TypeError, ValueError):
+        return None
+    if "tools" in params:
+        return True
+    if any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values()):
+        return None
+    return False
+
+
+def _invoke_llm_stream(llm: Any, model: Any, prompt_messages: list[Any], tools: Any) -> Any:
+    llm_type = type(llm)
+    try:
+        supports_tools = _LLM_SUPPORTS_TOOLS[llm_type]
+    except KeyError:
+        supports_tools = _LLM_SUPPORTS_TOOLS[llm_type] = _invoke_accepts_tools(llm)
+    if supports_tools is not False:
+        # A TypeError from a call the signature allows only skips tools for this call.
+        try:
+            return llm.invoke(model_config=model, prompt_messages=prompt_messages, tools=tools, stream=True)
+        except TypeError:
+            pass
+    return llm.invoke(model_config=model, prompt_messages=prompt_messages, stream=True)
+
+
+def _prompt_tool_result(name: str, result: Any) -> Any:
+    max_chars = TOOL_RESULT_MAX_CHARS.get(name, TOOL_RESULT_DEFAULT_MAX_CHARS)
+    return _truncate_tool_result(result, max_chars, TOOL_RESULT_MAX_ENTRIES)
+
+
+_STR_ARGUMENTS = (
+    "skill_name",
+    "relative_path",
+    "source_relative_path",
+    "temp_relative_path",
+    "workspace_relative_path",
+    "content",
+)
+
+
+def _coerce_tool_arguments(arguments: dict[str, Any]) -> dict[str, Any]:
+    # Every argument the dispatcher reads, coerced once per call; integer
+    # arguments stay raw because their defaults differ per tool.
+    args = {k: str(arguments.get(k) or "") for k in _STR_ARGUMENTS}
+    command = arguments.get("command")
+    cwd_relative = arguments.get("cwd_relative")
+    args["command"] = command if isinstance(command, list) else []
+    args["cwd_relative"] = str(cwd_relative) if cwd_relative else None
+    args["auto_install"] = bool(arguments.get("auto_install") or False)
+    args["overwrite"] = bool(arguments.get("overwrite") or False)
+    args["max_depth"] = arguments.get("max_depth")
+    args["max_chars"] = arguments.get("max_chars")
+    return args
+
+
+def _tool_progress_text(name: str, args: dict[str, Any]) -> str | None:
+    static = _TOOL_PROGRESS_STATIC.get(name)
+    if static is not None:
+        return static
+    tmpl = _TOOL_PROGRESS_TEMPLATES.get(name)
+    return tmpl.format_map(args) if tmpl is not None else None
+
+
+_TOOL_HANDLERS: dict[str, Callable[[_AgentRuntime, dict[str, Any]], Any]] = {
+    "get_skill_metadata": lambda rt, a: rt.get_skill_metadata(a["skill_name"]),
+    "list_skill_files": lambda rt, a: rt.list_skill_files(a["skill_name"], int(a["max_depth"] or 2)),
+    "read_skill_file": lambda rt, a: rt.read_skill_file(
+        a["skill_name"],
+        a["relative_path"],
+        int(a["max_chars"] or 12000),
+    ),
+    "run_skill_command": lambda rt, a: rt.run_skill_command(
+        skill_name=a["skill_name"],
+        command=a["command"],
+        cwd_relative=a["cwd_relative"],
+        auto_install=a["auto_install"],
+    ),
+    "get_session_context": lambda rt, a: rt.get_session_context(),
+    "write_temp_file": lambda rt, a: rt.write_temp_file(a["relative_path"], a["content"]),
+    "copy_temp_file": lambda rt, a: rt.copy_temp_file(a["source_relative_path"], a["relative_path"]),
+    "read_temp_file": lambda rt, a: rt.read_temp_file(a["relative_path"], int(a["max_chars"] or 12000)),
+    "list_temp_files": lambda rt, a: rt.list_temp_files(int(a["max_depth"] or 4)),
+    "run_temp_command": lambda rt, a: rt.run_temp_command(
+        command=a["command"],
+        cwd_relative=a["cwd_relative"],
+        auto_install=a["auto_install"],
+    ),
+    "export_temp_file": lambda rt, a: rt.export_temp_file(
+        temp_relative_path=a["temp_relative_path"],
+        workspace_relative_path=a["workspace_relative_path"],
+        overwrite=a["overwrite"],
+    ),
+}
+
+
+def _dispatch_tool(runtime: _AgentRuntime, name: str, args: dict[str, Any]) -> Any:
+    handler = _TOOL_HANDLERS.get(name)
+    return handler(runtime, args) if handler else {"error": f"unknown tool: {name}"}
+
+# Static part of the system prompt, filled in per invocation with str.format.
+_SYSTEM_PROMPT_TEMPLATE = (
+    "{system_prompt}"
+    "\n\n你是一个使用 Skills 文件夹作为“工具箱”的通用型 Agent。\n"
+    "\n[会话路径]\n"
+    "- session_dir: {session_dir}\n"
+    "- skills_root: {skills_root}\n"
+    "你必须遵循渐进式披露流程：\n"
+    "1) 只根据技能元数据（name/description）判断可能相关的技能\n"
+    "2) 触发时才调用 get_skill_metadata 读取 SKILL.md（说明文档）\n"
+    "3) 任何对技能的进一步操作（list_skill_files/read_skill_file/run_skill_command）之前，必须先 get_skill_metadata；若未执行，本系统会拒绝该调用并要求你先补读说明书。\n"
+    "4) 按说明书内容执行脚本/命令，或进一步搜索资料前，必须先调用 list_skill_files 查看技能包的目录结构，以确保在正确的目录执行命令。\n"
+    "5) 只有在需要更深信息时，才调用 read_skill_file\n"
+    "6) 只有在明确需要执行脚本/命令时，才调用 run_skill_command\n"
+    "7) 执行前必须先确认技能包内确实存在可执行入口（脚本/模块等），不要猜测模块名；如果缺少可执行入口，则先交付当前可交付产物，并询问用户是否允许你在 temp 目录中自行创建脚本后再尝试生成。\n"
+    "8) 按说明书要求生成最终文件后，必须用 export_temp_file 标记最终文件\n"
+    "路径规则：uploads/ 与你用 write_temp_file 生成的中间产物都位于 session_dir 下；run_skill_command 的 cwd 在 skills_root/<skill_name> 下。\n"
+    "因此：只要命令参数需要引用 uploads/ 或 temp 中间文件，一律使用 read_temp_file 返回的绝对路径（result.path）传给命令；不要使用 ../uploads、../../temp 这类相对路径猜测。\n"
+    "依赖安装规则：如需 npm install/npm ci/bun install，必须用 run_skill_command 在技能包内含 package.json 的目录执行（通过 cwd_relative 指到该目录）；禁止在 session_dir 执行 install，否则会写入 temp/<session>/node_modules 导致每次会话重复安装。\n"
+    "补充规则1：如果用户请求中已经明确给出具体类型/参数，则视为已确认，不要重复追问，直接进入对应分支执行。\n"
+    "补充规则2：当你需要向用户追问任何信息时：本轮必须只输出问题与选项，并立刻结束；不得在同一轮继续读取任何文件、执行任何命令、生成任何产物。\n"
+    "补充规则3：默认值只能在用户明确说‘默认/随便/你决定’时启用；用户未回复不等于选择了默认。"
+    "补充规则4：当你准备调用 write_temp_file 时，必须先在自然语言里输出一行“写入意图确认”，包含：relative_path + 内容摘要（前 80 字）+ 大致长度；然后再发起工具调用。relative_path 必须是文件路径（不能是空、'.'、'..'、不能以 '/' 结尾，不能指向目录）。\n"
+    "{uploads_context}"
+    "你必须把实现过程中的中间产物写入 temp 会话目录（脚本、草稿、生成物等）：\n"
+    "- 写文本：write_temp_file\n"
+    "- 复制已有文件：copy_temp_file（不要用 read_temp_file + write_temp_file 搬运文件内容）\n"
+    "- 运行命令生成文件：run_temp_command\n"
+    "对任何“有明确交付物”的请求，你必须在同一轮内推进直到：生成可交付文件，或给出明确失败原因。\n"
+    "只有调用 export_temp_file 标记的文件，才会作为最终交付文件返回给用户；uploads/ 与未标记文件不会回传。\n\n"
+    "可用动作：\n"
+    "- get_session_context()\n"
+    "- get_skill_metadata(skill_name)\n"
+    "- list_skill_files(skill_name, max_depth)\n"
+    "- read_skill_file(skill_name, relative_path, max_chars)\n"
+    "- run_skill_command(skill_name, command, cwd_relative, auto_install)\n"
+    "- write_temp_file(relative_path, content)\n"
+    "- copy_temp_file(source_relative_path, relative_path)\n"
+    "- read_temp_file(relative_path, max_chars)\n"
+    "- list_temp_files(max_depth)\n"
+    "- run_temp_command(command, cwd_relative, auto_install)\n"
+    "- export_temp_file(temp_relative_path, workspace_relative_path, overwrite)  # 不复制，仅标记交付名\n\n"
+    "如果模型支持 function call，请直接发起工具调用；若不支持，则用 JSON 协议响应：\n"
+    '{{"type":"tool","name":"get_skill_metadata","arguments":{{"skill_name":"xxx"}}}}\n'
+    '或 {{"type":"final","content":"..."}}\n\n'
+    "技能索引（用于判断是否需要调用技能）：\n"
+    "{skills_index_json}"
+    "{resume_context}"
+)
+
+
+# load_skills_index always yields {"root", "skills": [{"name", "folder", "description"}]},
+# so the flattened tuple is a complete key for its JSON encoding.
+def _skills_index_json(skills_index: dict[str, Any]) -> str:
+    skills = tuple((s["name"], s["folder"], s["description"]) for s in skills_index.get("skills") or [])
+    return _dump_skills_index(skills_index.get("root"), skills)
+
+
+@functools.lru_cache(maxsize=8)
+def _dump_skills_index(root: str | None, skills: tuple[tuple[str, str, str], ...]) -> str:
+    return _json_dumps({"root": root, "skills": [{"name": n, "folder": f, "description": d} for n, f, d in skills]})
+
+
+# Follow-up turns of a conversation usually render the same prompt (same session
+# dir, skills and empty upload/resume context), so the rendered text is reused.
+@functools.lru_cache(maxsize=32)
+def _render_system_content(
+    system_prompt: str,
+    session_dir: str,
+    skills_root: str | None,
+    uploads_context: str,
+    skills_index_json: str,
+    resume_context: str,
+) -> str:
+    return _SYSTEM_PROMPT_TEMPLATE.format(
+        system_prompt=system_prompt,
+        session_dir=session_dir,
+        skills_root=skills_root,
+        uploads_context=uploads_context,
+        skills_index_json=skills_index_json,
+        resume_context=resume_context,
+    )
+
+
 class SkillAgentTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         model = tool_parameters.get("model")
@@ -69,9 +379,7 @@ class SkillAgentTool(Tool):
         user_input = str(query)
 
         storage = self.session.storage
-        resume_key = _get_resume_storage_key(self.session)
-        history_key = _get_history_storage_key(self.session)
-        session_dir_key = _get_session_dir_storage_key(self.session)
+        resume_key, history_key, session_dir_key = _get_session_storage_keys(self.session)
         resume_state = _storage_get_json(storage, resume_key)
         resume_pending = bool(resume_state.get("pending"))
         is_resuming = False
@@ -95,7 +403,6 @@ class SkillAgentTool(Tool):
             if candidate:
                 session_dir = candidate
                 os.makedirs(session_dir, exist_ok=True)
-                _storage_set_text(storage, session_dir_key, session_dir)
                 original_query_for_resume = str(resume_state.get("original_query") or "").strip()
                 if original_query_for_resume:
                     query = original_query_for_resume
@@ -107,9 +414,10 @@ class SkillAgentTool(Tool):
                     + "请直接基于当前 temp 会话目录中的中间产物继续推进，优先生成最终可交付文件。\n"
                 )
         os.makedirs(session_dir, exist_ok=True)
-        _storage_set_text(storage, session_dir_key, session_dir)
+        if session_dir != persisted_session_dir:
+            _storage_set_text(storage, session_dir_key, session_dir)
         if not is_resuming:
-            _cleanup_old_temp_sessions(temp_root, keep=4, protect_dirs={session_dir})
+            _cleanup_old_temp_sessions_in_background(temp_root, keep=4, protect_dirs={session_dir})
 
         file_items: list[Any] = []
         files_param = tool_parameters.get("files")
@@ -120,60 +428,31 @@ class SkillAgentTool(Tool):
         elif tool_parameters.get("file"):
             file_items = [tool_parameters.get("file")]
 
-        uploads_context = ""
+        uploads_dir = _safe_join_cached(session_dir, "uploads")
+        os.makedirs(uploads_dir, exist_ok=True)
         if file_items:
-            uploads_dir = _safe_join(session_dir, "uploads")
-            os.makedirs(uploads_dir, exist_ok=True)
-            uploaded: list[dict[str, Any]] = []
+            sources: list[tuple[Any, Any]] = []
             for item in file_items:
                 url, name = _extract_url_and_name(item)
                 if not url:
                     yield self.create_text_message("❌未能获取上传文件 URL（files[i].url）。\n")
                     return
-                try:
-                    content = _download_file_content(str(url), timeout=45)
-                except Exception as e:
-                    yield self.create_text_message(f"❌文件下载失败：{str(e)}\n")
-                    return
+                sources.append((url, name))
+            targets: list[tuple[str, str]] = []
+            for url, name in sources:
                 ext = _infer_ext_from_url(str(url))
                 filename = _safe_filename(str(name) if name else None, fallback_ext=ext)
-                abs_path = os.path.join(uploads_dir, filename)
-                try:
-                    with open(abs_path, "wb") as f:
-                        f.write(content)
-                except Exception as e:
-                    yield self.create_text_message(f"❌保存上传文件失败：{str(e)}\n")
+                targets.append((str(url), os.path.join(uploads_dir, filename)))
+            # Uploads download at once straight to disk; when two share a name the
+            # later one wins, as it did when files were written one after another.
+            last_index = {path: i for i, (_, path) in enumerate(targets)}
+            targets = [t for i, t in enumerate(targets) if last_index[t[1]] == i]
+            for result in _download_files(targets, timeout=45):
+                if isinstance(result, Exception):
+                    yield self.create_text_message(f"❌文件下载失败：{str(result)}\n")
                     return
 
-                rel_path = f"uploads/{filename}"
-                mime = None
-                if isinstance(item, dict) and item.get("mime_type"):
-                    mime = str(item.get("mime_type") or "").strip() or None
-                if not mime:
-                    try:
-                        mime = _guess_mime_type(filename)
-                    except Exception:
-                        mime = None
-                uploaded.append(
-                    {
-                        "relative_path": rel_path,
-                        "bytes": len(content),
-                        "mime_type": mime or "",
-                        "filename": filename,
-                        "source_url": str(url),
-                    }
-                )
-
-            lines = ["\n\n[上传文件清单]", "以下路径均相对于本次会话的 session_dir："]
-            for f in uploaded:
-                lines.append(
-                    f"- {f.get('relative_path')} | mime={f.get('mime_type') or ''} | bytes={f.get('bytes') or 0} | filename={f.get('filename') or ''}"
-                )
-            uploads_context = "\n".join(lines) + "\n"
-        else:
-            uploads_dir = _safe_join(session_dir, "uploads")
-            os.makedirs(uploads_dir, exist_ok=True)
-
+        # Built from the uploads directory, so files from earlier turns are listed too.
         uploads_context = _build_uploads_context(session_dir)
 
         runtime = _AgentRuntime(
@@ -184,11 +463,13 @@ class SkillAgentTool(Tool):
         )
 
         history_messages: list[Any] = []
+        history_state: dict[str, Any] | None = None
         if history_turns > 0:
             history_state = _storage_get_json(storage, history_key)
             turns = history_state.get("turns")
             if isinstance(turns, list) and turns:
-                picked: list[tuple[str, str]] = []
+                acc: list[tuple[str, str]] = []
+                total = 0
                 for t in reversed(turns[-history_turns:]):
                     if not isinstance(t, dict):
                         continue
@@ -196,24 +477,18 @@ class SkillAgentTool(Tool):
                     a = str(t.get("assistant") or "").strip()
                     if not u and not a:
                         continue
-                    picked.append((u, a))
-                if picked:
-                    acc: list[tuple[str, str]] = []
-                    total = 0
-                    for u, a in picked:
-                        block_len = len(u) + len(a)
-                        if total + block_len > HISTORY_TRANSCRIPT_MAX_CHARS and acc:
-                            break
-                        acc.append((u, a))
-                        total += block_len
-                        if total >= HISTORY_TRANSCRIPT_MAX_CHARS:
-                            break
-                    acc.reverse()
-                    for u, a in acc:
-                        if u:
-                            history_messages.append(UserPromptMessage(content=u))
-                        if a:
-                            history_messages.append(AssistantPromptMessage(content=a))
+                    block_len = len(u) + len(a)
+                    if total + block_len > HISTORY_TRANSCRIPT_MAX_CHARS and acc:
+                        break
+                    acc.append((u, a))
+                    total += block_len
+                    if total >= HISTORY_TRANSCRIPT_MAX_CHARS:
+                        break
+                for u, a in reversed(acc):
+                    if u:
+                        history_messages.append(UserPromptMessage(content=u))
+                    if a:
+                        history_messages.append(AssistantPromptMessage(content=a))
 
         skills_index = runtime.load_skills_index()
         try:
@@ -226,218 +501,198 @@ class SkillAgentTool(Tool):
             + f" session_dir={session_dir} skills_root={skills_root!s} skills_count={skills_count} "
             + f"query_len={len(query)}"
         )
-        system_content = (
-            system_prompt.strip()
-            + "\n\n你是一个使用 Skills 文件夹作为“工具箱”的通用型 Agent。\n"
-            + "\n[会话路径]\n"
-            + f"- session_dir: {session_dir}\n"
-            + f"- skills_root: {skills_root}\n"
-            + "你必须遵循渐进式披露流程：\n"
-            + "1) 只根据技能元数据（name/description）判断可能相关的技能\n"
-            + "2) 触发时才调用 get_skill_metadata 读取 SKILL.md（说明文档）\n"
-            + "3) 任何对技能的进一步操作（list_skill_files/read_skill_file/run_skill_command）之前，必须先 get_skill_metadata；若未执行，本系统会拒绝该调用并要求你先补读说明书。\n"
-            + "4) 按说明书内容执行脚本/命令，或进一步搜索资料前，必须先调用 list_skill_files 查看技能包的目录结构，以确保在正确的目录执行命令。\n"
-            + "5) 只有在需要更深信息时，才调用 read_skill_file\n"
-            + "6) 只有在明确需要执行脚本/命令时，才调用 run_skill_command\n"
-            + "7) 执行前必须先确认技能包内确实存在可执行入口（脚本/模块等），不要猜测模块名；如果缺少可执行入口，则先交付当前可交付产物，并询问用户是否允许你在 temp 目录中自行创建脚本后再尝试生成。\n"
-            + "8) 按说明书要求生成最终文件后，必须用 export_temp_file 标记最终文件\n"
-            + "路径规则：uploads/ 与你用 write_temp_file 生成的中间产物都位于 session_dir 下；run_skill_command 的 cwd 在 skills_root/<skill_name> 下。\n"
-            + "因此：只要命令参数需要引用 uploads/ 或 temp 中间文件，一律使用 read_temp_file 返回的绝对路径（result.path）传给命令；不要使用 ../uploads、../../temp 这类相对路径猜测。\n"
-            + "依赖安装规则：如需 npm install/npm ci/bun install，必须用 run_skill_command 在技能包内含 package.json 的目录执行（通过 cwd_relative 指到该目录）；禁止在 session_dir 执行 install，否则会写入 temp/<session>/node_modules 导致每次会话重复安装。\n"
-            + "补充规则1：如果用户请求中已经明确给出具体类型/参数，则视为已确认，不要重复追问，直接进入对应分支执行。\n"
-            + "补充规则2：当你需要向用户追问任何信息时：本轮必须只输出问题与选项，并立刻结束；不得在同一轮继续读取任何文件、执行任何命令、生成任何产物。\n"
-            + "补充规则3：默认值只能在用户明确说‘默认/随便/你决定’时启用；用户未回复不等于选择了默认。"
-            + "补充规则4：当你准备调用 write_temp_file 时，必须先在自然语言里输出一行“写入意图确认”，包含：relative_path + 内容摘要（前 80 字）+ 大致长度；然后再发起工具调用。relative_path 必须是文件路径（不能是空、'.'、'..'、不能以 '/' 结尾，不能指向目录）。\n"
-            + (uploads_context or "")
-            + "你必须把实现过程中的中间产物写入 temp 会话目录（脚本、草稿、生成物等）：\n"
-            + "- 写文本：write_temp_file\n"
-            + "- 运行命令生成文件：run_temp_command\n"
-            + "对任何“有明确交付物”的请求，你必须在同一轮内推进直到：生成可交付文件，或给出明确失败原因。\n"
-            + "只有调用 export_temp_file 标记的文件，才会作为最终交付文件返回给用户；uploads/ 与未标记文件不会回传。\n\n"
-            + "可用动作：\n"
-            + "- get_session_context()\n"
-            + "- get_skill_metadata(skill_name)\n"
-            + "- list_skill_files(skill_name, max_depth)\n"
-            + "- read_skill_file(skill_name, relative_path, max_chars)\n"
-            + "- run_skill_command(skill_name, command, cwd_relative, auto_install)\n"
-            + "- write_temp_file(relative_path, content)\n"
-            + "- read_temp_file(relative_path, max_chars)\n"
-            + "- list_temp_files(max_depth)\n"
-            + "- run_temp_command(command, cwd_relative, auto_install)\n"
-            + "- export_temp_file(temp_relative_path, workspace_relative_path, overwrite)  # 不复制，仅标记交付名\n\n"
-            + "如果模型支持 function call，请直接发起工具调用；若不支持，则用 JSON 协议响应：\n"
-            + '{"type":"tool","name":"get_skill_metadata","arguments":{"skill_name":"xxx"}}\n'
-            + '或 {"type":"final","content":"..."}\n\n'
-            + "技能索引（用于判断是否需要调用技能）：\n"
-            + json.dumps(skills_index, ensure_ascii=False)
-            + (resume_context or "")
+        system_content = _render_system_content(
+            system_prompt.strip(),
+            session_dir,
+            skills_root,
+            uploads_context or "",
+            _skills_index_json(skills_index),
+            resume_context or "",
         )
 
-        messages: list[Any] = [SystemPromptMessage(content=system_content)]
+        system_msg = SystemPromptMessage(content=system_content)
+        # The memory window (memory_turns * 4 messages after the system prompt)
+        # is enforced by the deque itself as messages are appended.
+        messages: deque[Any] = deque(maxlen=memory_turns * 4 if memory_turns > 0 else None)
         if history_messages:
             messages.extend(history_messages)
         messages.append(UserPromptMessage(content=query))
 
-        def compact() -> None:
-            if memory_turns <= 0:
-                return
-            keep = 1 + memory_turns * 4
-            if len(messages) > keep:
-                system_msg = messages[0]
-                tail = messages[-(keep - 1) :]
-                messages[:] = [system_msg, *tail]
-
         final_text: str | None = None
-        final_file_meta: dict[str, dict[str, str]] = {}
+        # temp relative path -> delivery filename/mime; oldest exports drop past EXPORT_FILES_MAX.
+        final_file_meta: OrderedDict[str, dict[str, str]] = OrderedDict()
         empty_responses = 0
         saved_asset_fingerprints: set[str] = set()
-        resume_saved = False
+        # Hashes of the raw base64 text of assets already handled; a repeat is
+        # skipped before it is decoded.
+        saved_asset_prehashes: set[str] = set()
+        # (step, message, tool name, raw result, json protocol) for large tool results.
+        elidable_results: deque[tuple[int, Any, str, Any, bool]] = deque()
+        # Written once in the finally block rather than from inside the tool loop.
+        pending_resume_state: dict[str, Any] | None = None
         final_text_already_streamed = False
 
-        def stream_text_to_user(text: str, chunk_size: int = 8) -> Generator[ToolInvokeMessage]:
+        def stream_text_to_user(text: str) -> Generator[ToolInvokeMessage]:
             s = (text or "").strip()
             if not s:
                 return
-            step = max(1, int(chunk_size))
-            for i in range(0, len(s), step):
-                yield self.create_text_message(s[i : i + step])
+            yield self.create_text_message(s)
+
+        redact_literals = [
+            variant
+            for p in (session_dir, skills_root)
+            if p and isinstance(p, str)
+            for variant in (p, p.replace("\\", "/"))
+        ]
 
         def redact_user_visible_text(text: str) -> str:
             s = str(text or "")
             if not s:
                 return s
-            for p in [session_dir, skills_root]:
-                if p and isinstance(p, str):
-                    s = s.replace(p, "<REDACTED_PATH>")
-                    s = s.replace(p.replace("\\", "/"), "<REDACTED_PATH>")
-            s = re.sub(r"[A-Za-z]:\\[^\s\r\n\t\"']+", "<REDACTED_PATH>", s)
-            s = re.sub(r"/[^\s\r\n\t\"']+", "<REDACTED_PATH>", s)
+            for literal in redact_literals:
+                s = s.replace(literal, "<REDACTED_PATH>")
+            s = _WINDOWS_PATH_RE.sub("<REDACTED_PATH>", s)
+            s = _POSIX_PATH_RE.sub("<REDACTED_PATH>", s)
             return s
 
+        def redact_user_visible_prefix(text: str, limit: int) -> str:
+            # No redaction spans a line break, so redacting whole-line blocks until
+            # the output passes limit gives the same prefix as redacting everything.
+            s = str(text or "")
+            out: list[str] = []
+            size = 0
+            pos = 0
+            while pos < len(s) and size <= limit:
+                end = s.find("\n", pos + limit)
+                end = len(s) if end < 0 else end + 1
+                piece = redact_user_visible_text(s[pos:end])
+                out.append(piece)
+                size += len(piece)
+                pos = end
+            return "".join(out)
+
+        def record_export(args: dict[str, Any], result: Any) -> None:
+            temp_rel = args["temp_relative_path"]
+            if isinstance(result, dict) and not result.get("error") and temp_rel and result.get("filename"):
+                meta = final_file_meta.get(temp_rel)
+                if meta is None:
+                    final_file_meta[temp_rel] = {"filename": result["filename"], "mime_type": result["mime_type"]}
+                elif meta["filename"] != result["filename"]:
+                    meta["filename"] = result["filename"]
+                    meta["mime_type"] = result["mime_type"]
+                while len(final_file_meta) > EXPORT_FILES_MAX:
+                    final_file_meta.popitem(last=False)
+
+        llm_assets_dir = _safe_join_cached(session_dir, "llm_assets")
+        # Paths taken in llm_assets, filled from one listing when the directory is first needed.
+        llm_asset_paths: set[str] | None = None
+
         def persist_llm_assets(parts: Any) -> list[str]:
+            nonlocal llm_asset_paths
             if not parts or not isinstance(parts, list):
                 return []
             saved: list[str] = []
-            out_dir = _safe_join(session_dir, "llm_assets")
-            os.makedirs(out_dir, exist_ok=True)
+            out_dir = llm_assets_dir
             for i, item in enumerate(parts):
                 if not isinstance(item, dict):
                     continue
                 item_type = str(item.get("type") or "")
-                if item_type not in {"image", "document", "audio", "video"}:
+                if item_type not in _LLM_ASSET_TYPES:
                     continue
                 mime = str(item.get("mime_type") or "")
                 filename = str(item.get("filename") or "").strip()
                 url = str(item.get("url") or item.get("data") or "").strip()
                 b64 = str(item.get("base64_data") or "").strip()
-                raw: bytes | None = None
+                if not b64 and not (url.startswith("data:") and ";base64," in url):
+                    continue
+                pre_key = _content_digest(f"{item_type}|{mime}|".encode() + (b64 or url).encode()).hexdigest()
+                if pre_key in saved_asset_prehashes:
+                    continue
+                if llm_asset_paths is None:
+                    os.makedirs(out_dir, exist_ok=True)
+                    llm_asset_paths = {os.path.join(out_dir, name) for name in os.listdir(out_dir)}
+                # Decode straight into a staging file; it is renamed once the
+                # fingerprint shows the asset is new, and dropped otherwise.
+                staging = os.path.join(out_dir, f".{uuid.uuid4().hex}.part")
+                fp: str | None = None
                 if b64:
                     try:
-                        raw = base64.b64decode(b64, validate=False)
+                        fp = _decode_base64_to_file(b64, staging)
                     except Exception:
-                        raw = None
-                if raw is None and url.startswith("data:") and ";base64," in url:
+                        fp = None
+                if fp is None and url.startswith("data:") and ";base64," in url:
                     try:
                         header, payload = url.split(";base64,", 1)
                         if not mime and header.startswith("data:"):
                             mime = header[5:]
-                        raw = base64.b64decode(payload, validate=False)
+                        fp = _decode_base64_to_file(payload, staging)
                     except Exception:
-                        raw = None
-                if raw is None:
-                    continue
-                try:
-                    fp = hashlib.sha1(raw).hexdigest()
-                    key = f"{item_type}|{mime}|{fp}"
-                except Exception:
-                    key = f"{item_type}|{mime}|{len(raw)}"
-                if key in saved_asset_fingerprints:
+                        fp = None
+                if fp is not None:
+                    saved_asset_prehashes.add(pre_key)
+                key = f"{item_type}|{mime}|{fp}"
+                if fp is None or key in saved_asset_fingerprints:
+                    try:
+                        os.remove(staging)
+                    except OSError:
+                        pass
                     continue
                 saved_asset_fingerprints.add(key)
                 if not filename:
                     ext = ""
                     if mime:
-                        if "png" in mime:
-                            ext = ".png"
-                        elif "jpeg" in mime or "jpg" in mime:
-                            ext = ".jpg"
-                        elif "pdf" in mime:
-                            ext = ".pdf"
-                        elif "json" in mime:
-                            ext = ".json"
-                        elif "text" in mime or "markdown" in mime:
-                            ext = ".txt"
-                    filename = f"{item_type}-{i+1}{ext or ''}"
-                dst = _safe_join(out_dir, filename)
-                if os.path.exists(dst):
-                    base, ext = os.path.splitext(filename)
-                    dst = _safe_join(out_dir, f"{base}-{fp[:8] if 'fp' in locals() else uuid.uuid4().hex[:8]}{ext}")
+                        base_mime = mime.partition(";")[0].strip().lower()
+                        ext = _LLM_ASSET_EXT_BY_MIME.get(base_mime) or mimetypes.guess_extension(base_mime) or ""
+                    filename = f"{item_type}-{i+1}{ext}"
                 try:
-                    with open(dst, "wb") as f:
-                        f.write(raw)
+                    # The set only knows names this function saw; files that tools
+                    # or skill commands wrote into llm_assets/ later are caught by
+                    # the exists() check on a miss.
+                    dst = _safe_join(out_dir, filename)
+                    if dst in llm_asset_paths or os.path.exists(dst):
+                        base, ext = os.path.splitext(filename)
+                        dst = _safe_join(out_dir, f"{base}-{fp[:8]}{ext}")
+                        n = 2
+                        while dst in llm_asset_paths or os.path.exists(dst):
+                            dst = _safe_join(out_dir, f"{base}-{fp[:8]}-{n}{ext}")
+                            n += 1
+                    os.replace(staging, dst)
+                    llm_asset_paths.add(dst)
                     saved.append(os.path.relpath(dst, session_dir))
                 except Exception:
+                    try:
+                        os.remove(staging)
+                    except OSError:
+                        pass
                     continue
             return saved
 
         def invoke_llm_live(
             *, prompt_messages: list[Any], tools: list[Any] | None
-        ) -> Generator[ToolInvokeMessage, None, tuple[str, list[Any], Any, int, bool]]:
+        ) -> Generator[ToolInvokeMessage, None, tuple[str, list[Any], Any, int, bool, tuple[str, Any] | None]]:
             nontext_content: list[dict[str, Any]] = []
             tool_calls_all: list[Any] = []
-            text_parts: list[str] = []
             chunks_count = 0
             streamed_any = False
             saw_tool_calls = False
-            typing_chunk = 6
             emitted_prefix = False
-            emitted_len = 0
+            # Visible text not yet sent; only the first pending_ok chars passed the gate.
+            pending = ""
+            pending_ok = 0
+            sniffer = _JsonSniffer()
 
             def emit_typing(text: str) -> Generator[ToolInvokeMessage, None, None]:
                 nonlocal streamed_any
                 if not text:
                     return
-                tagged = "\n【🤖Skill_Agent】\n" + text.strip() + "\n\n"
-                step = max(1, int(typing_chunk))
-                for i in range(0, len(tagged), step):
-                    yield self.create_text_message(tagged[i : i + step])
-                    streamed_any = True
+                yield self.create_text_message("\n【🤖Skill_Agent】\n" + text.strip() + "\n\n")
+                streamed_any = True
             
             def should_emit_user_text(text: str) -> bool:
-                if not text:
-                    return False
-                s = str(text)
-                stripped = s.lstrip()
-                if stripped.startswith("{") and _extract_first_json_object(s) is None:
-                    return False
-                if stripped.startswith("```") and stripped.count("```") < 2:
-                    return False
-                json_text = _extract_first_json_object(text)
-                if not json_text:
-                    return True
-                try:
-                    obj = json.loads(json_text)
-                except Exception:
-                    return True
-                if not isinstance(obj, dict):
-                    return True
-                t = obj.get("type")
-                return t not in {"tool", "final"}
+                return bool(text) and _JsonSniffer().feed(str(text)) == "text"
 
             try:
-                try:
-                    response = self.session.model.llm.invoke(
-                        model_config=model,
-                        prompt_messages=prompt_messages,
-                        tools=tools,
-                        stream=True,
-                    )
-                except TypeError:
-                    response = self.session.model.llm.invoke(
-                        model_config=model,
-                        prompt_messages=prompt_messages,
-                        stream=True,
-                    )
+                response = _invoke_llm_stream(self.session.model.llm, model, prompt_messages, tools)
 
                 if _safe_get(response, "message") is not None:
                     msg = _safe_get(response, "message") or {}
@@ -450,57 +705,67 @@ class SkillAgentTool(Tool):
                         tool_calls_all.extend(tool_calls)
                         if tool_calls:
                             saw_tool_calls = True
-                    if text:
-                        text_parts.append(text)
-                    combined_text = "".join(text_parts).strip()
+                    combined_text = (text or "").strip()
                     if combined_text and not saw_tool_calls and should_emit_user_text(combined_text):
                         yield from emit_typing(combined_text)
-                    return combined_text, tool_calls_all, nontext_content, chunks_count, streamed_any
+                    return combined_text, tool_calls_all, nontext_content, chunks_count, streamed_any, None
 
-                for chunk in response:
+                chunk_iter = iter(response)
+                first_chunk = next(chunk_iter, None)
+                get = _pick_accessor(first_chunk)
+                for chunk in itertools.chain(() if first_chunk is None else (first_chunk,), chunk_iter):
                     chunks_count += 1
-                    delta = _safe_get(chunk, "delta") or {}
-                    msg = _safe_get(delta, "message") or {}
-                    content = _safe_get(msg, "content")
+                    msg = get(get(chunk, "delta"), "message")
+                    content = get(msg, "content")
                     t, parts = _split_message_content(content)
                     if parts:
                         nontext_content.extend(parts)
-                    tc = _safe_get(msg, "tool_calls") or []
+                    tc = get(msg, "tool_calls") or []
                     if isinstance(tc, list) and tc:
                         tool_calls_all.extend(tc)
                         if not saw_tool_calls:
                             saw_tool_calls = True
                     if t:
-                        text_parts.append(t)
-                        combined_text_live = "".join(text_parts).strip()
-                        if combined_text_live and not saw_tool_calls and should_emit_user_text(combined_text_live):
+                        state = sniffer.feed(t)
+                        pending += sniffer.visible
+                        if state == "text" and not saw_tool_calls and pending:
                             if not emitted_prefix:
                                 yield self.create_text_message("\n【🤖Skill_Agent】\n")
                                 emitted_prefix = True
-                            new = combined_text_live[emitted_len:]
-                            if new:
-                                step = max(1, int(typing_chunk))
-                                for i in range(0, len(new), step):
-                                    yield self.create_text_message(new[i : i + step])
-                                    streamed_any = True
-                                emitted_len = len(combined_text_live)
-                combined_text = "".join(text_parts).strip()
+                            # Coalesce upstream deltas so each message carries a line or a few words.
+                            pending_ok = len(pending)
+                            if pending_ok >= _STREAM_FLUSH_CHARS or "\n" in pending:
+                                yield self.create_text_message(pending)
+                                streamed_any = True
+                                pending = ""
+                                pending_ok = 0
+                combined_text = sniffer.text.strip()
                 if emitted_prefix:
-                    yield self.create_text_message("\n\n")
-                elif combined_text and not saw_tool_calls and should_emit_user_text(combined_text):
+                    yield self.create_text_message(pending[:pending_ok] + "\n\n")
+                    if pending_ok:
+                        streamed_any = True
+                elif combined_text and not saw_tool_calls and sniffer.state == "text":
                     yield from emit_typing(combined_text)
-                return combined_text, tool_calls_all, nontext_content, chunks_count, streamed_any
+                sniffed = (sniffer.json_text, sniffer.json_obj) if sniffer.json_text is not None else None
+                return combined_text, tool_calls_all, nontext_content, chunks_count, streamed_any, sniffed
             except Exception as e:
-                return "", [], {"error": "stream_parse_failed", "exception": str(e)}, chunks_count, streamed_any
+                return "", [], {"error": "stream_parse_failed", "exception": str(e)}, chunks_count, streamed_any, None
 
         try:
             for step_idx in range(max_steps):
-                compact()
-                _dbg(f"step={step_idx+1}/{max_steps} messages={len(messages)}")
+                _dbg(f"step={step_idx+1}/{max_steps} messages={len(messages) + 1}")
+                while elidable_results and elidable_results[0][0] <= step_idx - TOOL_RESULT_ELIDE_AFTER_STEPS:
+                    _, old_msg, old_name, old_result, json_protocol = elidable_results.popleft()
+                    stub = _elide_tool_result(old_name, old_result)
+                    old_msg.content = (
+                        "TOOL_RESULT\n" + _format_tool_result(old_name, stub)
+                        if json_protocol
+                        else _json_dumps(stub)
+                    )
                 try:
-                    res_text, tool_calls, nontext, chunks, streamed_any = yield from invoke_llm_live(
-                        prompt_messages=messages,
-                        tools=_build_prompt_message_tools(TOOL_SCHEMAS, PromptMessageTool),
+                    res_text, tool_calls, nontext, chunks, streamed_any, sniffed = yield from invoke_llm_live(
+                        prompt_messages=[system_msg, *messages],
+                        tools=PROMPT_MESSAGE_TOOLS,
                     )
                 except Exception as e:
                     msg = str(e)
@@ -518,64 +783,87 @@ class SkillAgentTool(Tool):
                         yield self.create_text_message("❌ LLM 调用失败：\n" + msg)
                     return
 
-                _dbg(
-                    f"llm_return content_len={len(res_text)} tool_calls={len(tool_calls)} chunks={chunks} "
-                    f"nontext={_shorten_text(nontext, 200) if nontext else ''}"
-                )
+                if _DEBUG_ENABLED:
+                    _dbg(
+                        f"llm_return content_len={len(res_text)} tool_calls={len(tool_calls)} chunks={chunks} "
+                        f"nontext={_shorten_text(nontext, 200) if nontext else ''}"
+                    )
                 if nontext:
                     saved_assets = persist_llm_assets(nontext)
-                    if saved_assets:
+                    if saved_assets and _DEBUG_ENABLED:
                         _dbg(f"nontext_assets_saved={len(saved_assets)} paths={_shorten_text(saved_assets, 300)}")
                 if tool_calls:
                     empty_responses = 0
                     messages.append(AssistantPromptMessage(content=res_text or "", tool_calls=tool_calls))
                     forced_text: str | None = None
-                    for tc in tool_calls:
-                        call_id, name, arguments = _parse_tool_call(tc)
+                    parsed_calls = [_parse_tool_call(tc) for tc in tool_calls]
+                    # If any call in the batch is malformed none of them run, so the
+                    # model retries the whole batch instead of patching around results.
+                    invalid_calls: dict[int, str] = {}
+                    for idx, (_, name, arguments) in enumerate(parsed_calls):
+                        ok_args, arg_detail = _validate_tool_arguments(str(name or ""), arguments)
+                        if not ok_args:
+                            invalid_calls[idx] = arg_detail
+                    for idx, (call_id, name, arguments) in enumerate(parsed_calls):
                         tool_name = str(name or "")
-                        _dbg(f"tool_call name={tool_name} id={call_id!s} args={_shorten_text(arguments, 400)}")
+                        if _DEBUG_ENABLED:
+                            _dbg(f"tool_call name={tool_name} id={call_id!s} args={_shorten_text(arguments, 400)}")
 
-                        ok_args, arg_detail = _validate_tool_arguments(tool_name, arguments)
-                        if not ok_args:
+                        if idx in invalid_calls:
+                            arg_detail = invalid_calls[idx]
                             result = {
                                 "error": "invalid_tool_arguments",
                                 "tool": tool_name,
                                 "detail": arg_detail,
                                 "got": arguments,
+                                "retry_hint": _tool_call_retry_prompt(tool_name, arg_detail),
                             }
-                            _dbg(f"tool_result name={tool_name} result={_shorten_text(result, 700)}")
+                            content = _json_dumps(result)
+                            _dbg(f"tool_result name={tool_name} result={_shorten_text(content, 700)}")
+                            messages.append(
+                                ToolPromptMessage(
+                                    tool_call_id=str(call_id or ""),
+                                    name=tool_name,
+                                    content=content,
+                                )
+                            )
+                            continue
+                        if invalid_calls:
                             messages.append(
                                 ToolPromptMessage(
                                     tool_call_id=str(call_id or ""),
                                     name=tool_name,
-                                    content=json.dumps(result, ensure_ascii=False),
+                                    content=_json_dumps(
+                                        {
+                                            "error": "not_executed",
+                                            "tool": tool_name,
+                                            "detail": "同一批次中有工具调用参数不合法，本调用未执行；请修正后重新发起整批调用。",
+                                        }
+                                    ),
                                 )
                             )
-                            messages.append(UserPromptMessage(content=_tool_call_retry_prompt(tool_name, arg_detail)))
                             continue
 
-                        if tool_name in {"list_skill_files", "read_skill_file", "run_skill_command"}:
-                            skill_name = str(arguments.get("skill_name") or "").strip()
+                        args = _coerce_tool_arguments(arguments)
+                        if tool_name in _SKILL_GATED_TOOLS:
+                            skill_name = args["skill_name"].strip()
                             if skill_name and not runtime.has_skill_metadata(skill_name):
                                 result = {
                                     "error": "skill_md_required",
                                     "skill_name": skill_name,
                                     "detail": "必须先调用 get_skill_metadata(skill_name) 读取 SKILL.md（说明书）后，才能继续调用该工具。",
+                                    "retry_hint": (
+                                        f"你刚才尝试调用 `{tool_name}` 但尚未读取技能《{skill_name}》的 SKILL.md。"
+                                        f"请先调用 get_skill_metadata({skill_name!r})，再重试该工具调用。"
+                                    ),
                                 }
-                                _dbg(f"tool_result name={tool_name} result={_shorten_text(result, 700)}")
+                                content = _json_dumps(result)
+                                _dbg(f"tool_result name={tool_name} result={_shorten_text(content, 700)}")
                                 messages.append(
                                     ToolPromptMessage(
                                         tool_call_id=str(call_id or ""),
                                         name=tool_name,
-                                        content=json.dumps(result, ensure_ascii=False),
-                                    )
-                                )
-                                messages.append(
-                                    UserPromptMessage(
-                                        content=(
-                                            f"你刚才尝试调用 `{tool_name}` 但尚未读取技能《{skill_name}》的 SKILL.md。"
-                                            f"请先调用 get_skill_metadata({skill_name!r})，再重试该工具调用。"
-                                        )
+                                        content=content,
                                     )
                                 )
                                 continue
@@ -584,205 +872,101 @@ class SkillAgentTool(Tool):
                                     "error": "skill_files_listing_required",
                                     "skill_name": skill_name,
                                     "detail": "执行技能命令前，必须先调用 list_skill_files(skill_name) 查看技能包目录结构。",
+                                    "retry_hint": (
+                                        f"你刚才尝试调用 `{tool_name}` 但尚未查看技能《{skill_name}》的目录结构。"
+                                        f"请先调用 list_skill_files({skill_name!r})，再重试该工具调用。"
+                                    ),
                                 }
-                                _dbg(f"tool_result name={tool_name} result={_shorten_text(result, 700)}")
+                                content = _json_dumps(result)
+                                _dbg(f"tool_result name={tool_name} result={_shorten_text(content, 700)}")
                                 messages.append(
                                     ToolPromptMessage(
                                         tool_call_id=str(call_id or ""),
                                         name=tool_name,
-                                        content=json.dumps(result, ensure_ascii=False),
-                                    )
-                                )
-                                messages.append(
-                                    UserPromptMessage(
-                                        content=(
-                                            f"你刚才尝试调用 `{tool_name}` 但尚未查看技能《{skill_name}》的目录结构。"
-                                            f"请先调用 list_skill_files({skill_name!r})，再重试该工具调用。"
-                                        )
+                                        content=content,
                                     )
                                 )
                                 continue
 
-                        if tool_name == "get_skill_metadata":
-                            yield self.create_text_message(
-                                f"✅正在查看技能《{str(arguments.get('skill_name') or '')}》说明书…\n"
-                            )
-                        elif tool_name == "list_skill_files":
-                            yield self.create_text_message(
-                                f"✅正在查看技能《{str(arguments.get('skill_name') or '')}》文件结构…\n"
-                            )
-                        elif tool_name == "read_skill_file":
-                            yield self.create_text_message(
-                                f"✅正在读取技能《{str(arguments.get('skill_name') or '')}》文件：{str(arguments.get('relative_path') or '')}…\n"
-                            )
-                        elif tool_name == "run_skill_command":
-                            yield self.create_text_message(
-                                f"✅正在执行技能《{str(arguments.get('skill_name') or '')}》命令…\n"
-                            )
-                        elif tool_name == "write_temp_file":
-                            yield self.create_text_message(
-                                f"✅正在按说明书写入临时文件：{str(arguments.get('relative_path') or '')}…\n"
-                            )
-                        elif tool_name == "read_temp_file":
-                            yield self.create_text_message(
-                                f"✅正在读取临时文件：{str(arguments.get('relative_path') or '')}…\n"
-                            )
-                        elif tool_name == "list_temp_files":
-                            yield self.create_text_message("✅正在查看临时目录文件…\n")
-                        elif tool_name == "run_temp_command":
-                            yield self.create_text_message("✅正在执行临时命令…\n")
-                        elif tool_name == "export_temp_file":
-                            yield self.create_text_message(
-                                f"✅正在标记交付文件：{str(arguments.get('temp_relative_path') or '')}…\n"
-                            )
+                        progress = _tool_progress_text(tool_name, args)
+                        if progress:
+                            yield self.create_text_message(progress)
 
-                        if tool_name == "get_skill_metadata":
-                            result = runtime.get_skill_metadata(str(arguments.get("skill_name") or ""))
-                        elif tool_name == "list_skill_files":
-                            result = runtime.list_skill_files(
-                                str(arguments.get("skill_name") or ""),
-                                int(arguments.get("max_depth") or 2),
-                            )
-                        elif tool_name == "read_skill_file":
-                            result = runtime.read_skill_file(
-                                str(arguments.get("skill_name") or ""),
-                                str(arguments.get("relative_path") or ""),
-                                int(arguments.get("max_chars") or 12000),
-                            )
-                        elif tool_name == "run_skill_command":
-                            result = runtime.run_skill_command(
-                                skill_name=str(arguments.get("skill_name") or ""),
-                                command=arguments.get("command") if isinstance(arguments.get("command"), list) else [],
-                                cwd_relative=(
-                                    str(arguments.get("cwd_relative")) if arguments.get("cwd_relative") else None
-                                ),
-                                auto_install=bool(arguments.get("auto_install") or False),
-                            )
-                            if (
-                                isinstance(result, dict)
-                                and result.get("returncode") is not None
-                                and int(result.get("returncode") or 0) != 0
-                            ):
-                                stderr = str(result.get("stderr") or "").strip()
-                                if stderr:
-                                    yield self.create_text_message(
-                                        "❌命令执行失败（stderr）：\n" + _shorten_text(redact_user_visible_text(stderr), 1200) + "\n"
-                                    )
-                            if isinstance(result, dict) and result.get("error") == "no_executable_found":
-                                skill = str(result.get("skill") or arguments.get("skill_name") or "")
-                                module = str(result.get("module") or "")
-                                forced_text = (
-                                    f"当前技能“{skill}”的说明文档要求生成文件，但技能包内未找到可执行入口（例如脚本或 Python 模块）。\n"
-                                    f"本次尝试的入口为 python -m {module}，但在技能目录中不存在，因此无法继续生成目标文件。\n\n"
-                                    "我已先按技能说明生成了可交付的中间产物（例如设计哲学 .md）。\n"
-                                    "你是否允许我在 temp 目录中自行创建可执行脚本，并在需要时安装依赖后，再尝试生成最终文件？"
-                                )
-                                _storage_set_json(
-                                    storage,
-                                    resume_key,
-                                    {
-                                        "pending": True,
-                                        "session_dir": session_dir,
-                                        "original_query": query,
-                                        "reason": "no_executable_found",
-                                        "skill": skill,
-                                        "module": module,
-                                        "created_at": int(time.time()),
-                                    },
+                        result = _dispatch_tool(runtime, tool_name, args)
+                        if (
+                            tool_name in _COMMAND_TOOLS
+                            and isinstance(result, dict)
+                            and result.get("returncode") is not None
+                            and int(result.get("returncode") or 0) != 0
+                        ):
+                            stderr = str(result.get("stderr") or "").strip()
+                            if stderr:
+                                yield self.create_text_message(
+                                    "❌命令执行失败（stderr）：\n" + _shorten_text(redact_user_visible_prefix(stderr, 1200), 1200) + "\n"
                                 )
-                                resume_saved = True
-                                _dbg(
-                                    "resume_state_saved "
-                                    + _shorten_text(
-                                        {"session_dir": session_dir, "skill": skill, "module": module, "pending": True},
-                                        300,
-                                    )
-                                )
-                        elif tool_name == "get_session_context":
-                            result = runtime.get_session_context()
-                        elif tool_name == "write_temp_file":
-                            result = runtime.write_temp_file(
-                                str(arguments.get("relative_path") or ""),
-                                str(arguments.get("content") or ""),
-                            )
-                        elif tool_name == "read_temp_file":
-                            result = runtime.read_temp_file(
-                                str(arguments.get("relative_path") or ""),
-                                int(arguments.get("max_chars") or 12000),
+                        if (
+                            tool_name == "run_skill_command"
+                            and isinstance(result, dict)
+                            and result.get("error") == "no_executable_found"
+                        ):
+                            skill = str(result.get("skill") or args["skill_name"])
+                            module = str(result.get("module") or "")
+                            forced_text = (
+                                f"当前技能“{skill}”的说明文档要求生成文件，但技能包内未找到可执行入口（例如脚本或 Python 模块）。\n"
+                                f"本次尝试的入口为 python -m {module}，但在技能目录中不存在，因此无法继续生成目标文件。\n\n"
+                                "我已先按技能说明生成了可交付的中间产物（例如设计哲学 .md）。\n"
+                                "你是否允许我在 temp 目录中自行创建可执行脚本，并在需要时安装依赖后，再尝试生成最终文件？"
                             )
-                        elif tool_name == "list_temp_files":
-                            result = runtime.list_temp_files(int(arguments.get("max_depth") or 4))
-                        elif tool_name == "run_temp_command":
-                            result = runtime.run_temp_command(
-                                command=arguments.get("command") if isinstance(arguments.get("command"), list) else [],
-                                cwd_relative=(
-                                    str(arguments.get("cwd_relative")) if arguments.get("cwd_relative") else None
-                                ),
-                                auto_install=bool(arguments.get("auto_install") or False),
+                            pending_resume_state = {
+                                "pending": True,
+                                "session_dir": session_dir,
+                                "original_query": query,
+                                "reason": "no_executable_found",
+                                "skill": skill,
+                                "module": module,
+                                "created_at": int(time.time()),
+                            }
+                            _dbg(
+                                "resume_state_saved "
+                                + _shorten_text(
+                                    {"session_dir": session_dir, "skill": skill, "module": module, "pending": True},
+                                    300,
+                                )
                             )
-                            if (
-                                isinstance(result, dict)
-                                and result.get("returncode") is not None
-                                and int(result.get("returncode") or 0) != 0
-                            ):
-                                stderr = str(result.get("stderr") or "").strip()
-                                if stderr:
-                                    yield self.create_text_message(
-                                        "❌命令执行失败（stderr）：\n" + _shorten_text(redact_user_visible_text(stderr), 1200) + "\n"
-                                    )
                         elif tool_name == "export_temp_file":
-                            temp_rel = str(arguments.get("temp_relative_path") or "")
-                            workspace_rel = str(arguments.get("workspace_relative_path") or "")
-                            result = runtime.export_temp_file(
-                                temp_relative_path=temp_rel,
-                                workspace_relative_path=workspace_rel,
-                                overwrite=bool(arguments.get("overwrite") or False),
-                            )
-                            out_name = os.path.basename(workspace_rel) if workspace_rel else ""
-                            if (
-                                isinstance(result, dict)
-                                and not result.get("error")
-                                and temp_rel
-                                and out_name
-                            ):
-                                final_file_meta[temp_rel] = {
-                                    **(final_file_meta.get(temp_rel) or {}),
-                                    "filename": out_name,
-                                    "mime_type": _guess_mime_type(out_name),
-                                }
-                        else:
-                            result = {"error": f"unknown tool: {tool_name}"}
+                            record_export(args, result)
 
-                        _dbg(f"tool_result name={tool_name} result={_shorten_text(result, 700)}")
-                        messages.append(
-                            ToolPromptMessage(
-                                tool_call_id=str(call_id or ""),
-                                name=tool_name,
-                                content=json.dumps(result, ensure_ascii=False),
-                            )
+                        content = _json_dumps(_prompt_tool_result(tool_name, result))
+                        _dbg(f"tool_result name={tool_name} result={_shorten_text(content, 700)}")
+                        tool_msg = ToolPromptMessage(
+                            tool_call_id=str(call_id or ""),
+                            name=tool_name,
+                            content=content,
                         )
+                        messages.append(tool_msg)
+                        if len(content) >= TOOL_RESULT_ELIDE_MIN_CHARS and tool_name not in _UNELIDED_TOOLS:
+                            elidable_results.append((step_idx, tool_msg, tool_name, result, False))
                     if forced_text:
                         final_text = forced_text
                         break
                     if step_idx >= max_steps - 1:
                         try:
-                            has_files = any(
-                                e.get("type") == "file"
-                                for e in _list_dir(session_dir, max_depth=2)
-                                if isinstance(e, dict)
-                            )
+                            has_files = bool(final_file_meta) or _has_any_file(session_dir, max_depth=2)
                         except Exception:
-                            has_files = False
-                        if final_file_meta or has_files:
+                            has_files = bool(final_file_meta)
+                        if has_files:
                             final_text = "已生成文件。"
                             break
                     continue
 
-                json_text = _extract_first_json_object(res_text)
+                # The stream sniffer already located and decoded the first object.
+                json_text = sniffed[0] if sniffed else _extract_first_json_object(res_text)
                 action: dict[str, Any] | None = None
-                if json_text:
+                if sniffed and isinstance(sniffed[1], dict):
+                    action = sniffed[1]
+                elif json_text:
                     try:
-                        action = json.loads(json_text)
+                        action = _json_loads(json_text)
                     except Exception:
                         action = None
                 _dbg(f"json_protocol detected={bool(action)} snippet={_shorten_text(json_text or '', 200)}")
@@ -791,11 +975,10 @@ class SkillAgentTool(Tool):
                     empty_responses += 1
                     _dbg(f"empty_response_count={empty_responses}")
                     if empty_responses < 3:
-                        messages.append(
-                            UserPromptMessage(
-                                content='你刚才没有输出任何内容。请继续完成任务：如果支持函数调用请调用工具；否则请输出 JSON：{"type":"final","content":"..."}'
-                            )
-                        )
+                        # An empty reply adds nothing, so a nudge already at the end is not repeated.
+                        last = messages[-1] if messages else None
+                        if not (isinstance(last, UserPromptMessage) and last.content == _EMPTY_RESPONSE_NUDGE):
+                            messages.append(UserPromptMessage(content=_EMPTY_RESPONSE_NUDGE))
                         continue
                     final_text = "模型连续返回空响应，未生成任何结果。"
                     break
@@ -830,16 +1013,14 @@ class SkillAgentTool(Tool):
                         "detail": arg_detail,
                         "got": arguments,
                     }
-                    _dbg(f"json_tool_result name={name} result={_shorten_text(result, 700)}")
-                    messages.append(
-                        AssistantPromptMessage(
-                            content="TOOL_RESULT\n" + json.dumps({"name": name, "result": result}, ensure_ascii=False)
-                        )
-                    )
+                    encoded = _format_tool_result(name, result)
+                    _dbg(f"json_tool_result name={name} result={_shorten_text(encoded, 700)}")
+                    messages.append(AssistantPromptMessage(content="TOOL_RESULT\n" + encoded))
                     continue
 
-                if name in {"list_skill_files", "read_skill_file", "run_skill_command"}:
-                    skill_name = str(arguments.get("skill_name") or "").strip()
+                args = _coerce_tool_arguments(arguments)
+                if name in _SKILL_GATED_TOOLS:
+                    skill_name = args["skill_name"].strip()
                     if skill_name and not runtime.has_skill_metadata(skill_name):
                         messages.append(
                             UserPromptMessage(
@@ -854,12 +1035,9 @@ class SkillAgentTool(Tool):
                             "skill_name": skill_name,
                             "detail": "必须先调用 get_skill_metadata(skill_name) 读取 SKILL.md（说明书）后，才能继续调用该工具。",
                         }
-                        _dbg(f"json_tool_result name={name} result={_shorten_text(result, 700)}")
-                        messages.append(
-                            AssistantPromptMessage(
-                                content="TOOL_RESULT\n" + json.dumps({"name": name, "result": result}, ensure_ascii=False)
-                            )
-                        )
+                        encoded = _format_tool_result(name, result)
+                        _dbg(f"json_tool_result name={name} result={_shorten_text(encoded, 700)}")
+                        messages.append(AssistantPromptMessage(content="TOOL_RESULT\n" + encoded))
                         continue
                     if name == "run_skill_command" and skill_name and not runtime.has_listed_skill_files(skill_name):
                         messages.append(
@@ -875,165 +1053,82 @@ class SkillAgentTool(Tool):
                             "skill_name": skill_name,
                             "detail": "执行技能命令前，必须先调用 list_skill_files(skill_name) 查看技能包目录结构。",
                         }
-                        _dbg(f"json_tool_result name={name} result={_shorten_text(result, 700)}")
-                        messages.append(
-                            AssistantPromptMessage(
-                                content="TOOL_RESULT\n" + json.dumps({"name": name, "result": result}, ensure_ascii=False)
-                            )
-                        )
+                        encoded = _format_tool_result(name, result)
+                        _dbg(f"json_tool_result name={name} result={_shorten_text(encoded, 700)}")
+                        messages.append(AssistantPromptMessage(content="TOOL_RESULT\n" + encoded))
                         continue
 
-                _dbg(f"json_tool name={name} args={_shorten_text(arguments, 400)}")
-                messages.append(AssistantPromptMessage(content=json.dumps(action, ensure_ascii=False)))
+                if _DEBUG_ENABLED:
+                    _dbg(f"json_tool name={name} args={_shorten_text(arguments, 400)}")
+                messages.append(AssistantPromptMessage(content=_json_dumps(action)))
 
-                if name == "get_skill_metadata":
-                    yield self.create_text_message(f"✅正在查看技能《{str(arguments.get('skill_name') or '')}》说明书…\n")
-                elif name == "list_skill_files":
-                    yield self.create_text_message(f"✅正在查看技能《{str(arguments.get('skill_name') or '')}》文件结构…\n")
-                elif name == "read_skill_file":
-                    yield self.create_text_message(
-                        f"✅正在读取技能《{str(arguments.get('skill_name') or '')}》文件：{str(arguments.get('relative_path') or '')}…\n"
-                    )
-                elif name == "run_skill_command":
-                    yield self.create_text_message(
-                        f"✅正在执行技能《{str(arguments.get('skill_name') or '')}》命令…\n"
-                    )
-                elif name == "write_temp_file":
-                    yield self.create_text_message(f"✅正在按说明书写入临时文件：{str(arguments.get('relative_path') or '')}…\n")
-                elif name == "read_temp_file":
-                    yield self.create_text_message(f"✅正在读取临时文件：{str(arguments.get('relative_path') or '')}…\n")
-                elif name == "list_temp_files":
-                    yield self.create_text_message("✅正在查看临时目录文件…\n")
-                elif name == "run_temp_command":
-                    yield self.create_text_message("✅正在执行临时命令…\n")
-                elif name == "export_temp_file":
-                    yield self.create_text_message(f"✅正在标记交付文件：{str(arguments.get('temp_relative_path') or '')}…\n")
-
-                if name == "get_skill_metadata":
-                    result = runtime.get_skill_metadata(str(arguments.get("skill_name") or ""))
-                elif name == "list_skill_files":
-                    result = runtime.list_skill_files(
-                        str(arguments.get("skill_name") or ""),
-                        int(arguments.get("max_depth") or 2),
-                    )
-                elif name == "read_skill_file":
-                    result = runtime.read_skill_file(
-                        str(arguments.get("skill_name") or ""),
-                        str(arguments.get("relative_path") or ""),
-                        int(arguments.get("max_chars") or 12000),
-                    )
-                elif name == "run_skill_command":
-                    result = runtime.run_skill_command(
-                        skill_name=str(arguments.get("skill_name") or ""),
-                        command=arguments.get("command") if isinstance(arguments.get("command"), list) else [],
-                        cwd_relative=(str(arguments.get("cwd_relative")) if arguments.get("cwd_relative") else None),
-                        auto_install=bool(arguments.get("auto_install") or False),
-                    )
-                elif name == "get_session_context":
-                    result = runtime.get_session_context()
-                elif name == "write_temp_file":
-                    result = runtime.write_temp_file(
-                        str(arguments.get("relative_path") or ""),
-                        str(arguments.get("content") or ""),
-                    )
-                elif name == "read_temp_file":
-                    result = runtime.read_temp_file(
-                        str(arguments.get("relative_path") or ""),
-                        int(arguments.get("max_chars") or 12000),
-                    )
-                elif name == "list_temp_files":
-                    result = runtime.list_temp_files(int(arguments.get("max_depth") or 4))
-                elif name == "run_temp_command":
-                    result = runtime.run_temp_command(
-                        command=arguments.get("command") if isinstance(arguments.get("command"), list) else [],
-                        cwd_relative=(str(arguments.get("cwd_relative")) if arguments.get("cwd_relative") else None),
-                        auto_install=bool(arguments.get("auto_install") or False),
-                    )
-                elif name == "export_temp_file":
-                    temp_rel = str(arguments.get("temp_relative_path") or "")
-                    workspace_rel = str(arguments.get("workspace_relative_path") or "")
-                    result = runtime.export_temp_file(
-                        temp_relative_path=temp_rel,
-                        workspace_relative_path=workspace_rel,
-                        overwrite=bool(arguments.get("overwrite") or False),
-                    )
-                    out_name = os.path.basename(workspace_rel) if workspace_rel else ""
-                    if (
-                        isinstance(result, dict)
-                        and not result.get("error")
-                        and temp_rel
-                        and out_name
-                    ):
-                        final_file_meta[temp_rel] = {
-                            **(final_file_meta.get(temp_rel) or {}),
-                            "filename": out_name,
-                            "mime_type": _guess_mime_type(out_name),
-                        }
-                else:
-                    result = {"error": f"unknown tool: {name}"}
+                progress = _tool_progress_text(name, args)
+                if progress:
+                    yield self.create_text_message(progress)
 
-                _dbg(f"json_tool_result name={name} result={_shorten_text(result, 700)}")
-                messages.append(
-                    AssistantPromptMessage(
-                        content="TOOL_RESULT\n" + json.dumps({"name": name, "result": result}, ensure_ascii=False)
-                    )
-                )
+                result = _dispatch_tool(runtime, name, args)
+                if name == "export_temp_file":
+                    record_export(args, result)
+
+                # The debug line reuses the encoded prompt text instead of serialising result again.
+                encoded = _format_tool_result(name, _prompt_tool_result(name, result))
+                _dbg(f"json_tool_result name={name} result={_shorten_text(encoded, 700)}")
+                content = "TOOL_RESULT\n" + encoded
+                result_msg = AssistantPromptMessage(content=content)
+                messages.append(result_msg)
+                if len(content) >= TOOL_RESULT_ELIDE_MIN_CHARS and name not in _UNELIDED_TOOLS:
+                    elidable_results.append((step_idx, result_msg, name, result, True))
             else:
                 try:
-                    has_files = any(
-                        e.get("type") == "file" for e in _list_dir(session_dir, max_depth=2) if isinstance(e, dict)
-                    )
+                    has_files = bool(final_file_meta) or _has_any_file(session_dir, max_depth=2)
                 except Exception:
-                    has_files = False
-                if final_file_meta or has_files:
+                    has_files = bool(final_file_meta)
+                if has_files:
                     final_text = "已生成文件。"
                 else:
                     final_text = f"❌超过最大执行轮数 max_steps={max_steps}，仍未得到最终结果"
         finally:
-            if not resume_saved and not is_resuming and resume_pending:
+            if pending_resume_state is not None:
+                _storage_set_json(storage, resume_key, pending_resume_state)
+            elif not is_resuming and resume_pending:
                 _storage_set_json(storage, resume_key, None)
-            temp_files_text = ""
+            has_any_files = False
             try:
-                temp_entries = _list_dir(session_dir, max_depth=10)
-                rel_paths = [
-                    str(e.get("relative_path"))
-                    for e in temp_entries
-                    if e.get("type") == "file" and isinstance(e.get("relative_path"), str)
-                ]
-                if rel_paths:
-                    temp_files_text = "\n\n[temp_files]\n" + "\n".join(rel_paths)
-                _dbg(f"temp_files_count={len(rel_paths)}")
+                # The full listing is only needed for the debug count.
+                if _DEBUG_ENABLED:
+                    rel_paths = _list_file_paths(session_dir, max_depth=10)
+                    has_any_files = bool(rel_paths)
+                    _dbg(f"temp_files_count={len(rel_paths)}")
+                else:
+                    has_any_files = _has_any_file(session_dir, max_depth=10)
             except Exception:
-                temp_files_text = ""
+                has_any_files = False
 
-            files_to_send: list[tuple[str, str, str, str]] = []
+            # (path, stat, mime, name) per distinct export; the stat taken here is reused when sending.
+            files_to_send: list[tuple[str, os.stat_result, str, str]] = []
             try:
+                seen_rels: set[str] = set()
                 for rel, meta_override in (final_file_meta or {}).items():
                     if not rel or not isinstance(rel, str):
                         continue
                     rel_norm = rel.replace("\\", "/").lstrip("/")
-                    if not rel_norm:
+                    if not rel_norm or rel_norm in seen_rels:
                         continue
+                    seen_rels.add(rel_norm)
                     try:
                         path = _safe_join(session_dir, rel_norm)
+                        st = os.stat(path)
                     except Exception:
                         continue
-                    if not os.path.isfile(path):
+                    if not stat.S_ISREG(st.st_mode):
                         continue
                     filename = os.path.basename(rel_norm)
                     out_name = (meta_override.get("filename") if isinstance(meta_override, dict) else None) or filename
                     mime_type = (meta_override.get("mime_type") if isinstance(meta_override, dict) else None) or _guess_mime_type(out_name or filename)
-                    files_to_send.append((rel_norm, path, mime_type, out_name))
+                    files_to_send.append((path, st, mime_type, out_name))
             except Exception:
                 files_to_send = []
 
-            has_any_files = False
-            try:
-                temp_entries = _list_dir(session_dir, max_depth=10)
-                has_any_files = any(e.get("type") == "file" for e in temp_entries if isinstance(e, dict))
-            except Exception:
-                has_any_files = False
-
             assistant_text_for_history = ""
             if final_text and final_text.strip():
                 if not files_to_send and final_text.strip() == "已生成文件。":
@@ -1044,6 +1139,7 @@ class SkillAgentTool(Tool):
                     history_key=history_key,
                     user_text=user_input,
                     assistant_text=assistant_text_for_history,
+                    state=history_state,
                 )
                 if not final_text_already_streamed:
                     yield from stream_text_to_user(final_text)
@@ -1054,6 +1150,7 @@ class SkillAgentTool(Tool):
                     history_key=history_key,
                     user_text=user_input,
                     assistant_text=assistant_text_for_history,
+                    state=history_state,
                 )
                 yield from stream_text_to_user("已生成文件。")
             elif has_any_files:
@@ -1063,6 +1160,7 @@ class SkillAgentTool(Tool):
                     history_key=history_key,
                     user_text=user_input,
                     assistant_text=assistant_text_for_history,
+                    state=history_state,
                 )
                 yield from stream_text_to_user("已生成中间文件，但未调用 export_temp_file 标记交付文件。")
             else:
@@ -1072,26 +1170,43 @@ class SkillAgentTool(Tool):
                     history_key=history_key,
                     user_text=user_input,
                     assistant_text=assistant_text_for_history,
+                    state=history_state,
                 )
                 yield from stream_text_to_user("未生成任何文本或文件输出。")
 
-            yielded: set[str] = set()
-            yielded_fingerprints: set[str] = set()
-            for rel, path, mime_type, out_name in files_to_send:
-                if rel in yielded:
+            # "filename|mime" -> [size, path, digest or None, stat stamp] of each file sent under that name.
+            # Only a same-name, same-size file can be a duplicate, so hashing runs only then.
+            yielded_by_name: dict[str, list[list[Any]]] = {}
+            # Different relative paths may name the same file; those are skipped before reading.
+            yielded_files: set[tuple[str, int, int]] = set()
+            to_read: list[tuple[str, os.stat_result, str, str]] = []
+            for path, st, mime_type, out_name in files_to_send:
+                file_key = (f"{out_name}|{mime_type}", st.st_dev, st.st_ino)
+                if file_key in yielded_files:
+                    continue
+                yielded_files.add(file_key)
+                to_read.append((path, st, mime_type, out_name))
+            contents = _read_export_files([(path, st) for path, st, _, _ in to_read])
+            for (path, st, mime_type, out_name), content in zip(to_read, contents):
+                if content is None:
                     continue
-                yielded.add(rel)
                 try:
-                    with open(path, "rb") as fp:
-                        content = fp.read()
-                    try:
-                        content_fp = hashlib.sha1(content).hexdigest()
-                    except Exception:
-                        content_fp = str(len(content))
-                    fingerprint_key = f"{out_name}|{mime_type}|{content_fp}"
-                    if fingerprint_key in yielded_fingerprints:
-                        continue
-                    yielded_fingerprints.add(fingerprint_key)
+                    same_name = yielded_by_name.setdefault(f"{out_name}|{mime_type}", [])
+                    candidates = [prev for prev in same_name if prev[0] == len(content)]
+                    content_fp: str | None = None
+                    if candidates:
+                        content_fp = _content_digest(content).hexdigest()
+                        for prev in candidates:
+                            if prev[2] is None:
+                                try:
+                                    prev[2] = _export_digest(prev[1], prev[3])
+                                except OSError:
+                                    prev[2] = ""
+                        if any(prev[2] == content_fp for prev in candidates):
+                            continue
+                    same_name.append(
+                        [len(content), path, content_fp, (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)]
+                    )
                     yield self.create_blob_message(blob=content, meta={"mime_type": mime_type, "filename": out_name})
                 except Exception:
                     continue
@@ -3,6 +3,16 @@ HISTORY_KEY_PREFIX = "skill:history:"
 SESSION_DIR_KEY_PREFIX = "skill:session_dir:"
 
 HISTORY_TRANSCRIPT_MAX_CHARS = 6000
+EXPORT_FILES_MAX = 1024
 
-ALLOWED_COMMANDS = {"python", "pip", "node", "pandoc", "soffice", "pdftoppm", "npm", "npx", "bun"}
+# Caps on bulky tool result fields before they enter the prompt; command output
+# is capped tighter than file reads, which already stop at 12000 chars.
+TOOL_RESULT_MAX_CHARS = {"run_skill_command": 6000, "run_temp_command": 6000}
+TOOL_RESULT_DEFAULT_MAX_CHARS = 12000
+TOOL_RESULT_MAX_ENTRIES = 200
+# Large results older than this many steps are replaced by a short stub.
+TOOL_RESULT_ELIDE_AFTER_STEPS = 4
+TOOL_RESULT_ELIDE_MIN_CHARS = 2000
+
+ALLOWED_COMMANDS = frozenset({"python", "pip", "node", "pandoc", "soffice", "pdftoppm", "npm", "npx", "bun"})
 TEMP_SESSION_PREFIX = "dify-skill-"
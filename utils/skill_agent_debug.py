@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import os
 from typing import Any
 
 from utils.tools import _safe_get
 
+# Debug lines are on unless SKILL_AGENT_DEBUG is set to 0/false/off; call sites
+# that build costly arguments check this before formatting them.
+_DEBUG_ENABLED = os.getenv("SKILL_AGENT_DEBUG", "1").strip().lower() not in {"0", "false", "off", "no"}
+
 
 def _dbg(msg: str) -> None:
+    if not _DEBUG_ENABLED:
+        return
     try:
         print(f"[skill][debug] {msg}", flush=True)
     except Exception:
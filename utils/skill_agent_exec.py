@@ -6,11 +6,34 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
 from utils.skill_agent_constants import TEMP_SESSION_PREFIX
 
+_SAFE_MODULE_NAME_RE = re.compile(r"[A-Za-z0-9_.-]+")
+
+# Modules already found or installed in this process; pip runs in a child
+# interpreter, so only positive results are remembered.
+_AVAILABLE_PYTHON_MODULES: set[str] = set()
+
+# (skill_path, module base) -> ((skill dir mtime, module dir mtime), found); only
+# answers decided by direct children of those two directories are kept, since a
+# file added deeper in the package tree changes neither mtime.
+_SKILL_MODULE_CACHE: dict[tuple[str, str], tuple[tuple[int | None, int | None], bool]] = {}
+
+# (command name, PATH) -> resolved executable; only hits are kept, since a missing
+# tool may be installed later, and a hit is re-checked with one access() call.
+_RESOLVED_EXECUTABLES: dict[tuple[str, str], str] = {}
+
+# Held by the background cleanup; a cleanup requested while one runs, or within
+# _CLEANUP_MIN_INTERVAL seconds of the last one, is skipped.
+_CLEANUP_LOCK = threading.Lock()
+_CLEANUP_MIN_INTERVAL = 60.0
+_last_cleanup_at: float | None = None
+
 
 def _detect_skills_root(explicit_path: str | None) -> str | None:
     if explicit_path and os.path.isdir(explicit_path):
@@ -52,24 +75,80 @@ def _cleanup_old_temp_sessions(temp_root: str, *, keep: int, protect_dirs: set[s
         excess = len(entries) - keep
         if excess <= 0:
             return
-        for _, path in entries[:excess]:
+        stale = [path for _, path in entries[:excess]]
+        if len(stale) == 1:
+            _remove_temp_session(stale[0])
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(stale))) as pool:
+            list(pool.map(_remove_temp_session, stale))
+    except Exception:
+        return
+
+
+def _cleanup_old_temp_sessions_in_background(
+    temp_root: str, *, keep: int, protect_dirs: set[str] | None = None
+) -> None:
+    global _last_cleanup_at
+    if not _CLEANUP_LOCK.acquire(blocking=False):
+        return
+    now = time.monotonic()
+    if _last_cleanup_at is not None and now - _last_cleanup_at < _CLEANUP_MIN_INTERVAL:
+        _CLEANUP_LOCK.release()
+        return
+    _last_cleanup_at = now
+
+    def run() -> None:
+        try:
+            _cleanup_old_temp_sessions(temp_root, keep=keep, protect_dirs=protect_dirs)
+        finally:
+            _CLEANUP_LOCK.release()
+
+    try:
+        threading.Thread(target=run, name="skill-temp-cleanup", daemon=True).start()
+    except Exception:
+        _CLEANUP_LOCK.release()
+
+
+def _remove_temp_session(path: str) -> None:
+    try:
+        for _ in range(2):
             try:
-                for _ in range(2):
-                    try:
-                        shutil.rmtree(path, ignore_errors=False)
-                        break
-                    except Exception:
-                        time.sleep(0.1)
-                else:
-                    shutil.rmtree(path, ignore_errors=True)
+                shutil.rmtree(path, ignore_errors=False)
+                return
             except Exception:
-                continue
+                time.sleep(0.1)
+        shutil.rmtree(path, ignore_errors=True)
     except Exception:
         return
 
 
 def _is_safe_module_name(name: str) -> bool:
-    return bool(re.fullmatch(r"[A-Za-z0-9_.-]+", name or ""))
+    return bool(_SAFE_MODULE_NAME_RE.fullmatch(name or ""))
+
+
+def _tree_contains_python_file(root: str) -> bool:
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.lower().endswith(".py"):
+                            return True
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return False
+
+
+def _mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
 
 
 def _skill_contains_python_module(skill_path: str, module_name: str) -> bool:
@@ -78,25 +157,44 @@ def _skill_contains_python_module(skill_path: str, module_name: str) -> bool:
         return False
     if not _is_safe_module_name(base):
         return False
+    dir_candidate = os.path.join(skill_path, base)
+    cache_key = (skill_path, base)
+    stamp = (_mtime_ns(skill_path), _mtime_ns(dir_candidate))
+    cached = _SKILL_MODULE_CACHE.get(cache_key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    found, cacheable = _scan_skill_python_module(skill_path, base, dir_candidate)
+    if cacheable:
+        _SKILL_MODULE_CACHE[cache_key] = (stamp, found)
+    else:
+        _SKILL_MODULE_CACHE.pop(cache_key, None)
+    return found
+
+
+def _scan_skill_python_module(skill_path: str, base: str, dir_candidate: str) -> tuple[bool, bool]:
+    # Returns (found, cacheable).
     file_candidate = os.path.join(skill_path, base + ".py")
     if os.path.isfile(file_candidate):
-        return True
-    dir_candidate = os.path.join(skill_path, base)
+        return True, True
     if not os.path.isdir(dir_candidate):
-        return False
+        return False, True
     init_candidate = os.path.join(dir_candidate, "__init__.py")
     if os.path.isfile(init_candidate):
-        return True
-    for _, _, files in os.walk(dir_candidate):
-        if any(str(f).lower().endswith(".py") for f in files):
-            return True
-    return False
+        return True, True
+    return _tree_contains_python_file(dir_candidate), False
 
 
 def _ensure_python_module(module_name: str, *, auto_install: bool, cwd: str) -> dict[str, Any]:
     if not module_name or not _is_safe_module_name(module_name):
         return {"ok": False, "error": "invalid module name", "module": module_name}
-    if importlib.util.find_spec(module_name) is not None:
+    if module_name in _AVAILABLE_PYTHON_MODULES:
+        return {"ok": True, "module": module_name}
+    try:
+        found = importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        found = False
+    if found:
+        _AVAILABLE_PYTHON_MODULES.add(module_name)
         return {"ok": True, "module": module_name}
     if not auto_install:
         return {"ok": False, "error": "python module not found", "module": module_name}
@@ -111,6 +209,8 @@ def _ensure_python_module(module_name: str, *, auto_install: bool, cwd: str) ->
             errors="ignore",
         )
         if result.returncode == 0:
+            importlib.invalidate_caches()
+            _AVAILABLE_PYTHON_MODULES.add(module_name)
             return {"ok": True, "module": module_name, "installed": True}
         return {
             "ok": False,
@@ -132,6 +232,17 @@ def _resolve_executable(exe: str) -> str | None:
 
     if _is_abs_path(e):
         return e
+    key = (e, os.environ.get("PATH", ""))
+    found = _RESOLVED_EXECUTABLES.get(key)
+    if found is not None and os.access(found, os.X_OK):
+        return found
+    found = _which_executable(e)
+    if found:
+        _RESOLVED_EXECUTABLES[key] = found
+    return found
+
+
+def _which_executable(e: str) -> str | None:
     found = shutil.which(e)
     if found:
         return found
@@ -5,6 +5,9 @@ import re
 
 from utils.tools import _safe_join
 
+_WINDOWS_ABS_PATH_RE = re.compile(r"^[A-Za-z]:[\\/]")
+_UPLOADS_PATH_RE = re.compile(r"^(?:\./|../)*uploads/(.+)$")
+
 
 def _normalize_relative_file_path(relative_path: str) -> str | None:
     rp = str(relative_path or "").strip()
@@ -27,106 +30,69 @@ def _is_abs_path(path: str) -> bool:
     p = str(path)
     if os.path.isabs(p):
         return True
-    return bool(re.match(r"^[A-Za-z]:[\\/]", p))
-
-
-def _rewrite_out_arg_to_session_dir(command: list[str], *, session_dir: str) -> list[str]:
-    if not command:
-        return command
-    out_flag = "--out"
-    rewritten: list[str] = []
-    i = 0
-    while i < len(command):
-        arg = command[i]
-        if isinstance(arg, str) and arg == out_flag and i + 1 < len(command):
-            out_path = command[i + 1]
-            if isinstance(out_path, str) and out_path and not _is_abs_path(out_path):
-                rp = _normalize_relative_file_path(out_path)
-                if rp:
-                    out_path = _safe_join(session_dir, rp)
-            rewritten.extend([arg, out_path])
-            i += 2
-            continue
-        if isinstance(arg, str) and arg.startswith(out_flag + "="):
-            out_path = arg.split("=", 1)[-1]
-            if out_path and not _is_abs_path(out_path):
-                rp = _normalize_relative_file_path(out_path)
-                if rp:
-                    out_path = _safe_join(session_dir, rp)
-            rewritten.append(out_flag + "=" + out_path)
-            i += 1
-            continue
-        rewritten.append(arg)
-        i += 1
-    return rewritten
+    return bool(_WINDOWS_ABS_PATH_RE.match(p))
 
 
-def _rewrite_uploads_paths_to_session_dir(command: list[str], *, session_dir: str) -> list[str]:
+def _rewrite_command_args(command: list[str], *, session_dir: str, rewrite_out: bool) -> list[str]:
+    # One pass applying, per argument and in this order: uploads/ paths to the
+    # session copy, existing session files to absolute paths, then (for skill
+    # commands) the value of --out / --out= to a session path.
     if not command:
         return command
     rewritten: list[str] = []
+    out_value_next = False
     for arg in command:
-        if not isinstance(arg, str) or not arg.strip():
-            rewritten.append(arg)
-            continue
-        if "://" in arg:
-            rewritten.append(arg)
-            continue
-        if _is_abs_path(arg):
+        if isinstance(arg, str) and arg.strip() and "://" not in arg and not _is_abs_path(arg):
+            if "=" in arg and arg.lstrip().startswith("-"):
+                k, v = arg.split("=", 1)
+                arg = k + "=" + _rewrite_uploads_path(v, session_dir)
+            else:
+                arg = _rewrite_uploads_path(arg, session_dir)
+            if arg.strip() and not arg.lstrip().startswith("-") and "://" not in arg and not _is_abs_path(arg):
+                arg = _rewrite_existing_session_file(arg, session_dir)
+        if not rewrite_out:
             rewritten.append(arg)
             continue
+        if out_value_next:
+            out_value_next = False
+            if isinstance(arg, str):
+                arg = _rewrite_out_path(arg, session_dir)
+        elif isinstance(arg, str) and arg == "--out":
+            out_value_next = True
+        elif isinstance(arg, str) and arg.startswith("--out="):
+            arg = "--out=" + _rewrite_out_path(arg.split("=", 1)[-1], session_dir)
+        rewritten.append(arg)
+    return rewritten
 
-        def try_rewrite_path(p: str) -> str:
-            s = str(p or "").strip()
-            s_norm = s.replace("\\", "/")
-            m = re.match(r"^(?:\./|../)*uploads/(.+)$", s_norm)
-            if not m:
-                return s
-            tail = m.group(1)
-            rp = _normalize_relative_file_path("uploads/" + tail)
-            if not rp:
-                return s
-            abs_path = _safe_join(session_dir, rp)
-            if os.path.isfile(abs_path):
-                return abs_path
-            return s
 
-        if "=" in arg and arg.lstrip().startswith("-"):
-            k, v = arg.split("=", 1)
-            v2 = try_rewrite_path(v)
-            rewritten.append(k + "=" + v2)
-        else:
-            rewritten.append(try_rewrite_path(arg))
-    return rewritten
+def _rewrite_out_path(out_path: str, session_dir: str) -> str:
+    if out_path and not _is_abs_path(out_path):
+        rp = _normalize_relative_file_path(out_path)
+        if rp:
+            return _safe_join(session_dir, rp)
+    return out_path
 
 
-def _rewrite_existing_session_files_to_abs(command: list[str], *, session_dir: str) -> list[str]:
-    if not command:
-        return command
-    rewritten: list[str] = []
-    for arg in command:
-        if not isinstance(arg, str) or not arg.strip():
-            rewritten.append(arg)
-            continue
-        if arg.lstrip().startswith("-"):
-            rewritten.append(arg)
-            continue
-        if "://" in arg:
-            rewritten.append(arg)
-            continue
-        if _is_abs_path(arg):
-            rewritten.append(arg)
-            continue
+def _rewrite_uploads_path(p: str, session_dir: str) -> str:
+    s = str(p or "").strip()
+    m = _UPLOADS_PATH_RE.match(s.replace("\\", "/"))
+    if not m:
+        return s
+    rp = _normalize_relative_file_path("uploads/" + m.group(1))
+    if not rp:
+        return s
+    abs_path = _safe_join(session_dir, rp)
+    if os.path.isfile(abs_path):
+        return abs_path
+    return s
 
-        def try_rewrite_path(p: str) -> str:
-            s = str(p or "").strip()
-            rp = _normalize_relative_file_path(s)
-            if not rp:
-                return s
-            abs_path = _safe_join(session_dir, rp)
-            if os.path.isfile(abs_path):
-                return abs_path
-            return s
 
-        rewritten.append(try_rewrite_path(arg))
-    return rewritten
+def _rewrite_existing_session_file(p: str, session_dir: str) -> str:
+    s = str(p or "").strip()
+    rp = _normalize_relative_file_path(s)
+    if not rp:
+        return s
+    abs_path = _safe_join(session_dir, rp)
+    if os.path.isfile(abs_path):
+        return abs_path
+    return s
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 import os
+import shutil
+import stat
 import subprocess
 import sys
+import threading
+from collections import OrderedDict
 from typing import Any
 
 from utils.skill_agent_constants import ALLOWED_COMMANDS
@@ -14,11 +18,59 @@ from utils.skill_agent_exec import (
 )
 from utils.skill_agent_paths import (
     _normalize_relative_file_path,
-    _rewrite_existing_session_files_to_abs,
-    _rewrite_out_arg_to_session_dir,
-    _rewrite_uploads_paths_to_session_dir,
+    _rewrite_command_args,
 )
-from utils.tools import _list_dir, _parse_frontmatter, _read_text, _safe_join
+from utils.tools import _guess_mime_type, _list_dir, _parse_frontmatter, _read_text, _safe_join, _safe_join_cached
+
+
+_PYTHON_EXECUTABLE = sys.executable
+
+_SKILL_MD_CACHE_MAX_ENTRIES = 256
+# (abs SKILL.md path, max_chars) -> (st_mtime_ns, st_size, content, frontmatter)
+_SKILL_MD_CACHE: OrderedDict[tuple[str, int], tuple[int, int, str, dict[str, str]]] = OrderedDict()
+_SKILL_MD_CACHE_LOCK = threading.Lock()
+
+
+def _read_skill_md(path: str, max_chars: int) -> tuple[str, dict[str, str]] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    key = (path, max_chars)
+    with _SKILL_MD_CACHE_LOCK:
+        cached = _SKILL_MD_CACHE.get(key)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            _SKILL_MD_CACHE.move_to_end(key)
+            return cached[2], cached[3]
+    content = _read_text(path, max_chars)
+    meta = _parse_frontmatter(content)
+    with _SKILL_MD_CACHE_LOCK:
+        _SKILL_MD_CACHE[key] = (st.st_mtime_ns, st.st_size, content, meta)
+        _SKILL_MD_CACHE.move_to_end(key)
+        while len(_SKILL_MD_CACHE) > _SKILL_MD_CACHE_MAX_ENTRIES:
+            _SKILL_MD_CACHE.popitem(last=False)
+    return content, meta
+
+
+def _decode_output(data: bytes | None) -> str:
+    # Same result as text=True with errors="ignore": one decode, then universal
+    # newlines, skipped when the output has no carriage returns.
+    text = (data or b"").decode("utf-8", errors="ignore")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text.strip()
+
+
+def _python_module_arg(command: list[str]) -> str | None:
+    try:
+        module_index = command.index("-m") + 1
+    except ValueError:
+        return None
+    if module_index < len(command):
+        return str(command[module_index])
+    return None
 
 
 class _AgentRuntime:
@@ -34,25 +86,33 @@ class _AgentRuntime:
         self.session_dir = session_dir
         self.max_steps = max_steps
         self.memory_turns = memory_turns
-        self._skill_metadata_cache: dict[str, dict[str, Any]] = {}
+        self._skill_metadata_loaded: set[str] = set()
         self._skill_files_listed: set[str] = set()
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._created_dirs: set[str] = set()
+
+    def _ensure_dir(self, path: str) -> None:
+        path = os.path.normpath(path)
+        if path in self._created_dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        self._created_dirs.add(path)
 
     def has_skill_metadata(self, skill_name: str) -> bool:
-        cached = self._skill_metadata_cache.get(skill_name)
-        return bool(isinstance(cached, dict) and cached.get("skill") == skill_name)
+        return skill_name in self._skill_metadata_loaded
 
     def load_skills_index(self) -> dict[str, Any]:
         if not self.skills_root:
             return {"root": None, "skills": []}
+        try:
+            with os.scandir(self.skills_root) as it:
+                folders = sorted((e.name, e.path) for e in it if e.is_dir())
+        except OSError:
+            folders = []
         skills: list[dict[str, Any]] = []
-        for folder in sorted(os.listdir(self.skills_root)):
-            path = os.path.join(self.skills_root, folder)
-            if not os.path.isdir(path):
-                continue
-            skill_md = os.path.join(path, "SKILL.md")
-            meta: dict[str, str] = {}
-            if os.path.isfile(skill_md):
-                meta = _parse_frontmatter(_read_text(skill_md, 4000))
+        for folder, path in folders:
+            cached = _read_skill_md(os.path.join(path, "SKILL.md"), 4000)
+            meta = cached[1] if cached else {}
             skills.append(
                 {
                     "name": meta.get("name") or folder,
@@ -65,19 +125,19 @@ class _AgentRuntime:
     def get_skill_metadata(self, skill_name: str) -> dict[str, Any]:
         if not self.skills_root:
             return {"error": "skills_root not found"}
-        path = _safe_join(self.skills_root, skill_name)
+        path = _safe_join_cached(self.skills_root, skill_name)
         skill_md = os.path.join(path, "SKILL.md")
-        if not os.path.isfile(skill_md):
+        cached = _read_skill_md(skill_md, 12000)
+        if cached is None:
             return {"error": "SKILL.md not found", "skill": skill_name}
-        content = _read_text(skill_md, 12000)
-        meta = _parse_frontmatter(content)
-        self._skill_metadata_cache[skill_name] = {"skill": skill_name, "metadata": meta}
-        return {"skill": skill_name, "metadata": meta, "skill_md": content}
+        content, meta = cached
+        self._skill_metadata_loaded.add(skill_name)
+        return {"skill": skill_name, "metadata": dict(meta), "skill_md": content}
 
     def list_skill_files(self, skill_name: str, max_depth: int = 2) -> dict[str, Any]:
         if not self.skills_root:
             return {"error": "skills_root not found"}
-        skill_path = _safe_join(self.skills_root, skill_name)
+        skill_path = _safe_join_cached(self.skills_root, skill_name)
         self._skill_files_listed.add(skill_name)
         return {"skill": skill_name, "entries": _list_dir(skill_path, max_depth=max_depth)}
 
@@ -87,14 +147,13 @@ class _AgentRuntime:
     def read_skill_file(self, skill_name: str, relative_path: str, max_chars: int = 12000) -> dict[str, Any]:
         if not self.skills_root:
             return {"error": "skills_root not found"}
-        skill_path = _safe_join(self.skills_root, skill_name)
+        skill_path = _safe_join_cached(self.skills_root, skill_name)
         file_path = _safe_join(skill_path, relative_path)
         if not os.path.isfile(file_path):
             return {"error": "file not found", "path": relative_path}
         return {"path": file_path, "content": _read_text(file_path, max_chars)}
 
     def write_temp_file(self, relative_path: str, content: str) -> dict[str, Any]:
-        os.makedirs(self.session_dir, exist_ok=True)
         rp = _normalize_relative_file_path(relative_path)
         if not rp:
             return {"error": "invalid relative_path", "relative_path": relative_path}
@@ -104,16 +163,47 @@ class _AgentRuntime:
             return {"error": "invalid relative_path", "relative_path": relative_path, "exception": str(e)}
         if os.path.isdir(path):
             return {"error": "path is a directory", "relative_path": relative_path, "path": path}
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._ensure_dir(os.path.dirname(path))
         try:
-            with open(path, "w", encoding="utf-8", newline="\n") as f:
-                f.write(content or "")
+            data = (content or "").encode("utf-8")
+            with open(path, "wb") as f:
+                f.write(data)
         except Exception as e:
             return {"error": "write failed", "relative_path": relative_path, "path": path, "exception": str(e)}
-        return {"path": path, "bytes": len((content or "").encode("utf-8"))}
+        return {"path": path, "bytes": len(data)}
+
+    def copy_temp_file(self, source_relative_path: str, relative_path: str) -> dict[str, Any]:
+        src_rp = _normalize_relative_file_path(source_relative_path)
+        if not src_rp:
+            return {"error": "invalid source_relative_path", "source_relative_path": source_relative_path}
+        rp = _normalize_relative_file_path(relative_path)
+        if not rp:
+            return {"error": "invalid relative_path", "relative_path": relative_path}
+        try:
+            src = _safe_join(self.session_dir, src_rp)
+            path = _safe_join(self.session_dir, rp)
+        except Exception as e:
+            return {
+                "error": "invalid relative_path",
+                "source_relative_path": source_relative_path,
+                "relative_path": relative_path,
+                "exception": str(e),
+            }
+        if not os.path.isfile(src):
+            return {"error": "source file not found", "source_relative_path": source_relative_path}
+        if os.path.isdir(path):
+            return {"error": "path is a directory", "relative_path": relative_path, "path": path}
+        self._ensure_dir(os.path.dirname(path))
+        try:
+            # copyfile uses os.sendfile on Linux, so the bytes never enter Python.
+            shutil.copyfile(src, path)
+        except shutil.SameFileError:
+            pass
+        except Exception as e:
+            return {"error": "copy failed", "relative_path": relative_path, "path": path, "exception": str(e)}
+        return {"path": path, "bytes": os.path.getsize(path)}
 
     def read_temp_file(self, relative_path: str, max_chars: int = 12000) -> dict[str, Any]:
-        os.makedirs(self.session_dir, exist_ok=True)
         rp = _normalize_relative_file_path(relative_path)
         if not rp:
             return {"error": "invalid relative_path", "relative_path": relative_path}
@@ -131,7 +221,6 @@ class _AgentRuntime:
             return {"error": "read failed", "relative_path": relative_path, "path": path, "exception": str(e)}
 
     def list_temp_files(self, max_depth: int = 4) -> dict[str, Any]:
-        os.makedirs(self.session_dir, exist_ok=True)
         return {"session_dir": self.session_dir, "entries": _list_dir(self.session_dir, max_depth=max_depth)}
 
     def get_session_context(self) -> dict[str, Any]:
@@ -152,24 +241,23 @@ class _AgentRuntime:
             return {"error": "skills_root not found"}
         if not command:
             return {"error": "command must be a non-empty list"}
-        skill_path = _safe_join(self.skills_root, skill_name)
+        skill_path = _safe_join_cached(self.skills_root, skill_name)
         exe = command[0]
         if exe == "python":
-            if "-m" in command:
-                module_index = command.index("-m") + 1
-                if module_index < len(command):
-                    module_name = command[module_index]
-                    if not _skill_contains_python_module(skill_path, str(module_name)):
-                        return {
-                            "error": "no_executable_found",
-                            "skill": skill_name,
-                            "reason": "python -m module not found in skill folder",
-                            "module": str(module_name),
-                        }
-                    module_check = _ensure_python_module(str(module_name), auto_install=auto_install, cwd=self.session_dir)
-                    if not module_check.get("ok"):
-                        return module_check
-            command = [sys.executable] + command[1:]
+            module_name = _python_module_arg(command)
+            if module_name is not None:
+                if not _skill_contains_python_module(skill_path, module_name):
+                    return {
+                        "error": "no_executable_found",
+                        "skill": skill_name,
+                        "reason": "python -m module not found in skill folder",
+                        "module": module_name,
+                    }
+                module_check = _ensure_python_module(module_name, auto_install=auto_install, cwd=self.session_dir)
+                if not module_check.get("ok"):
+                    return module_check
+            command = list(command)
+            command[0] = _PYTHON_EXECUTABLE
         elif exe not in ALLOWED_COMMANDS:
             return {"error": f"command not allowed: {exe}"}
         resolved0 = _resolve_executable(str(command[0] or ""))
@@ -177,20 +265,17 @@ class _AgentRuntime:
             missing = str(command[0] or exe)
             return {"error": "executable_not_found", "exe": missing, "hint": _missing_executable_hint(missing)}
         command = [resolved0] + command[1:]
-        command = _rewrite_uploads_paths_to_session_dir(command, session_dir=self.session_dir)
-        command = _rewrite_existing_session_files_to_abs(command, session_dir=self.session_dir)
-        command = _rewrite_out_arg_to_session_dir(command, session_dir=self.session_dir)
+        command = _rewrite_command_args(command, session_dir=self.session_dir, rewrite_out=True)
         cwd = skill_path if not cwd_relative else _safe_join(skill_path, cwd_relative)
+        # The command may remove directories created earlier in this session.
+        self._created_dirs.clear()
         try:
-            result = subprocess.run(
-                command,
-                cwd=cwd,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="ignore",
-            )
-            return {"returncode": result.returncode, "stdout": result.stdout.strip(), "stderr": result.stderr.strip()}
+            result = subprocess.run(command, cwd=cwd, capture_output=True)
+            return {
+                "returncode": result.returncode,
+                "stdout": _decode_output(result.stdout),
+                "stderr": _decode_output(result.stderr),
+            }
         except FileNotFoundError as e:
             return {"error": "executable_not_found", "exe": str(command[0] or exe), "exception": str(e)}
         except Exception as e:
@@ -203,14 +288,13 @@ class _AgentRuntime:
             return {"error": "command must be a non-empty list"}
         exe = command[0]
         if exe == "python":
-            if "-m" in command:
-                module_index = command.index("-m") + 1
-                if module_index < len(command):
-                    module_name = command[module_index]
-                    module_check = _ensure_python_module(str(module_name), auto_install=auto_install, cwd=self.session_dir)
-                    if not module_check.get("ok"):
-                        return module_check
-            command = [sys.executable] + command[1:]
+            module_name = _python_module_arg(command)
+            if module_name is not None:
+                module_check = _ensure_python_module(module_name, auto_install=auto_install, cwd=self.session_dir)
+                if not module_check.get("ok"):
+                    return module_check
+            command = list(command)
+            command[0] = _PYTHON_EXECUTABLE
         elif exe not in ALLOWED_COMMANDS:
             return {"error": f"command not allowed: {exe}"}
         resolved0 = _resolve_executable(str(command[0] or ""))
@@ -218,20 +302,17 @@ class _AgentRuntime:
             missing = str(command[0] or exe)
             return {"error": "executable_not_found", "exe": missing, "hint": _missing_executable_hint(missing)}
         command = [resolved0] + command[1:]
-        command = _rewrite_uploads_paths_to_session_dir(command, session_dir=self.session_dir)
-        command = _rewrite_existing_session_files_to_abs(command, session_dir=self.session_dir)
-        os.makedirs(self.session_dir, exist_ok=True)
+        command = _rewrite_command_args(command, session_dir=self.session_dir, rewrite_out=False)
         cwd = self.session_dir if not cwd_relative else _safe_join(self.session_dir, cwd_relative)
+        # The command may remove directories created earlier in this session.
+        self._created_dirs.clear()
         try:
-            result = subprocess.run(
-                command,
-                cwd=cwd,
-                capture_output=True,
-                text=True,
-                encoding="utf-8",
-                errors="ignore",
-            )
-            return {"returncode": result.returncode, "stdout": result.stdout.strip(), "stderr": result.stderr.strip()}
+            result = subprocess.run(command, cwd=cwd, capture_output=True)
+            return {
+                "returncode": result.returncode,
+                "stdout": _decode_output(result.stdout),
+                "stderr": _decode_output(result.stderr),
+            }
         except FileNotFoundError as e:
             return {"error": "executable_not_found", "exe": str(command[0] or exe), "exception": str(e)}
         except Exception as e:
@@ -244,7 +325,6 @@ class _AgentRuntime:
         workspace_relative_path: str,
         overwrite: bool = False,
     ) -> dict[str, Any]:
-        os.makedirs(self.session_dir, exist_ok=True)
         rp = _normalize_relative_file_path(temp_relative_path)
         if not rp:
             return {"error": "invalid temp_relative_path", "temp_relative_path": temp_relative_path}
@@ -252,15 +332,22 @@ class _AgentRuntime:
             src = _safe_join(self.session_dir, rp)
         except Exception as e:
             return {"error": "invalid temp_relative_path", "temp_relative_path": temp_relative_path, "exception": str(e)}
-        if os.path.isdir(src):
+        try:
+            st = os.stat(src)
+        except (OSError, ValueError):
+            st = None
+        if st is not None and stat.S_ISDIR(st.st_mode):
             return {"error": "source path is a directory", "temp_relative_path": temp_relative_path, "source": src}
-        if not os.path.isfile(src):
+        if st is None or not stat.S_ISREG(st.st_mode):
             return {"error": "source file not found", "temp_relative_path": temp_relative_path}
+        filename = os.path.basename(workspace_relative_path) if workspace_relative_path else ""
         return {
             "source": src,
             "relative_path": temp_relative_path,
-            "bytes": os.path.getsize(src),
+            "bytes": st.st_size,
             "note": "export_temp_file does not copy files; tool marks final output only",
             "requested_name": workspace_relative_path,
             "overwrite": overwrite,
+            "filename": filename,
+            "mime_type": _guess_mime_type(filename) if filename else "",
         }
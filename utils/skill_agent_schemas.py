@@ -3,7 +3,7 @@ from __future__ import annotations
 from typing import Any
 
 
-TOOL_SCHEMAS: list[dict[str, Any]] = [
+TOOL_SCHEMAS: tuple[dict[str, Any], ...] = (
     {
         "type": "function",
         "function": {
@@ -87,6 +87,21 @@ TOOL_SCHEMAS: list[dict[str, Any]] = [
             },
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "copy_temp_file",
+            "description": "在 temp 会话目录内复制文件（相对路径），不经过模型传输文件内容",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "source_relative_path": {"type": "string", "minLength": 1},
+                    "relative_path": {"type": "string", "minLength": 1},
+                },
+                "required": ["source_relative_path", "relative_path"],
+            },
+        },
+    },
     {
         "type": "function",
         "function": {
@@ -145,31 +160,26 @@ TOOL_SCHEMAS: list[dict[str, Any]] = [
             },
         },
     },
-]
+)
+
+
+# Required argument names per tool, taken once from the schemas above.
+_REQUIRED_ARGUMENTS: dict[str, tuple[str, ...]] = {
+    schema["function"]["name"]: tuple(schema["function"]["parameters"].get("required") or ())
+    for schema in TOOL_SCHEMAS
+}
 
 
 def _validate_tool_arguments(tool_name: str, arguments: Any) -> tuple[bool, str]:
     if not isinstance(arguments, dict):
         return False, "arguments 必须是对象(dict)"
 
-    required: dict[str, list[str]] = {
-        "get_skill_metadata": ["skill_name"],
-        "list_skill_files": ["skill_name"],
-        "read_skill_file": ["skill_name", "relative_path"],
-        "run_skill_command": ["skill_name", "command"],
-        "get_session_context": [],
-        "write_temp_file": ["relative_path", "content"],
-        "read_temp_file": ["relative_path"],
-        "list_temp_files": [],
-        "run_temp_command": ["command"],
-        "export_temp_file": ["temp_relative_path", "workspace_relative_path"],
-    }
-
-    if tool_name not in required:
+    required = _REQUIRED_ARGUMENTS.get(tool_name)
+    if required is None:
         return True, ""
 
     missing: list[str] = []
-    for key in required[tool_name]:
+    for key in required:
         val = arguments.get(key)
         if val is None:
             missing.append(key)
@@ -1,11 +1,10 @@
 from __future__ import annotations
 
-import json
 import time
 from typing import Any
 
 from utils.skill_agent_constants import HISTORY_KEY_PREFIX, RESUME_KEY_PREFIX, SESSION_DIR_KEY_PREFIX
-from utils.tools import _safe_get
+from utils.tools import _json_dumps, _json_loads, _safe_get
 
 
 def _get_session_storage_id(session: Any) -> str:
@@ -35,6 +34,11 @@ def _get_session_dir_storage_key(session: Any) -> str:
     return SESSION_DIR_KEY_PREFIX + _get_session_storage_id(session)
 
 
+def _get_session_storage_keys(session: Any) -> tuple[str, str, str]:
+    session_id = _get_session_storage_id(session)
+    return RESUME_KEY_PREFIX + session_id, HISTORY_KEY_PREFIX + session_id, SESSION_DIR_KEY_PREFIX + session_id
+
+
 def _storage_get_text(storage: Any, key: str) -> str:
     try:
         val = storage.get(key)
@@ -61,7 +65,7 @@ def _storage_get_json(storage: Any, key: str) -> dict[str, Any]:
     if not raw:
         return {}
     try:
-        val = json.loads(raw)
+        val = _json_loads(raw)
         return val if isinstance(val, dict) else {}
     except Exception:
         return {}
@@ -72,7 +76,7 @@ def _storage_set_json(storage: Any, key: str, value: dict[str, Any] | None) -> N
         _storage_set_text(storage, key, "")
         return
     try:
-        _storage_set_text(storage, key, json.dumps(value, ensure_ascii=False))
+        _storage_set_text(storage, key, _json_dumps(value))
     except Exception:
         _storage_set_text(storage, key, "")
         return
@@ -85,8 +89,10 @@ def _append_history_turn(
     user_text: str,
     assistant_text: str,
     max_turns: int = 50,
+    state: dict[str, Any] | None = None,
 ) -> None:
-    state = _storage_get_json(storage, history_key)
+    if state is None:
+        state = _storage_get_json(storage, history_key)
     turns = state.get("turns")
     if not isinstance(turns, list):
         turns = []
@@ -3,11 +3,11 @@ from __future__ import annotations
 import os
 from typing import Any
 
-from utils.tools import _guess_mime_type, _list_dir, _safe_join
+from utils.tools import _guess_mime_type, _list_dir, _safe_join_cached
 
 
 def _build_uploads_context(session_dir: str, *, max_files: int = 50) -> str:
-    uploads_dir = _safe_join(session_dir, "uploads")
+    uploads_dir = _safe_join_cached(session_dir, "uploads")
     if not os.path.isdir(uploads_dir):
         return ""
     entries = _list_dir(uploads_dir, max_depth=2)
@@ -1,14 +1,88 @@
 from __future__ import annotations
 
+import base64
+import binascii
+import codecs
+import functools
+import hashlib
+import io
 import json
 import mimetypes
 import os
 import re
+import shutil
+import threading
 import uuid
+from collections import OrderedDict
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, TypeVar
 from urllib.parse import urlparse
 from urllib.request import Request, urlopen
 
+try:
+    import orjson as _orjson
+except ImportError:  # optional speedup
+    _orjson = None
+
+try:
+    import requests as _requests
+except ImportError:  # optional; falls back to urllib without connection reuse
+    _requests = None
+
+_JSON_DECODER = json.JSONDecoder()
+_MIME_BY_EXT: dict[str, str] = {
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".xls": "application/vnd.ms-excel",
+    ".csv": "text/csv",
+    ".json": "application/json",
+    ".txt": "text/plain",
+    ".md": "text/markdown",
+    ".html": "text/html",
+    ".htm": "text/html",
+    ".pdf": "application/pdf",
+    ".zip": "application/zip",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".svg": "image/svg+xml",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".doc": "application/msword",
+    ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    ".ppt": "application/vnd.ms-powerpoint",
+    ".yaml": "application/yaml",
+    ".yml": "application/yaml",
+}
+_REPLY_STRIP_RE = re.compile(r"[\s。．\.，,！!？\?；;：:\-—_~`'\"]+")
+_DENY_REPLY_RE = re.compile("不允许|不同意|不可以|不要|拒绝|取消")
+_ALLOW_REPLY_RE = re.compile("允许|同意")
+_ALLOW_REPLY_WORDS = frozenset({"允许", "同意", "可以", "好的", "好", "ok", "okay", "yes", "y", "sure"})
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r"[<>:\"/\\\\|?*]+")
+# Multiple of 4, so every slice but the last decodes to whole bytes.
+_BASE64_CHUNK_CHARS = 64 * 1024
+
+
+def _json_loads(raw: str | bytes) -> Any:
+    if _orjson is not None:
+        try:
+            return _orjson.loads(raw)
+        except ValueError:
+            # orjson rejects NaN/Infinity and >64-bit ints that json accepts.
+            pass
+    return json.loads(raw)
+
+
+def _json_dumps(value: Any) -> str:
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(value, option=_orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            # Unsupported types and >64-bit ints; let json produce the result or the error.
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
 
 def _safe_get(obj: Any, key: str) -> Any:
     if isinstance(obj, dict):
@@ -22,107 +96,343 @@ def _safe_get(obj: Any, key: str) -> Any:
     except Exception:
         return None
 
+def _attr_get(obj: Any, key: str) -> Any:
+    return getattr(obj, key, None)
+
+
+def _dict_get(obj: Any, key: str) -> Any:
+    return obj.get(key) if isinstance(obj, dict) else None
+
+
+_MISSING = object()
+
+
+def _get_field(obj: Any, key: str) -> Any:
+    # _safe_get for SDK messages and tool calls: plain dicts and attributes are
+    # tried first, so the usual shapes never pay for a failed obj[key].
+    if obj.__class__ is dict:
+        return obj.get(key)
+    try:
+        value = getattr(obj, key, _MISSING)
+    except Exception:
+        value = _MISSING
+    return _safe_get(obj, key) if value is _MISSING else value
+
+
+def _pick_accessor(sample: Any) -> Callable[[Any, str], Any]:
+    # Stream chunks of one response share a shape; probe once instead of per field.
+    if isinstance(sample, dict):
+        return _dict_get
+    if hasattr(sample, "delta"):
+        return _attr_get
+    return _safe_get
+
+
 def _shorten_text(value: Any, max_len: int = 500) -> str:
     try:
-        s = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        s = value if isinstance(value, str) else _json_dumps(value)
     except Exception:
         s = str(value)
+    # Escaping only makes the text longer, so cut before escaping rather than
+    # rewriting a large payload that is truncated anyway.
+    truncated = max_len >= 3 and len(s) > max_len
+    if truncated:
+        s = s[:max_len]
     s = s.replace("\r", "\\r").replace("\n", "\\n")
-    if len(s) <= max_len:
+    if not truncated and len(s) <= max_len:
         return s
     return s[: max_len - 3] + "..."
 
 def _guess_mime_type(filename: str) -> str:
     name = (filename or "").strip().lower()
-    _, ext = os.path.splitext(name)
-    ext = ext.lower()
-    if ext:
-        overrides = {
-            ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            ".xls": "application/vnd.ms-excel",
-            ".csv": "text/csv",
-            ".json": "application/json",
-            ".txt": "text/plain",
-            ".md": "text/markdown",
-            ".html": "text/html",
-            ".htm": "text/html",
-            ".pdf": "application/pdf",
-            ".zip": "application/zip",
-            ".png": "image/png",
-            ".jpg": "image/jpeg",
-            ".jpeg": "image/jpeg",
-            ".gif": "image/gif",
-            ".webp": "image/webp",
-            ".svg": "image/svg+xml",
-            ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            ".doc": "application/msword",
-            ".pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-            ".ppt": "application/vnd.ms-powerpoint",
-            ".yaml": "application/yaml",
-            ".yml": "application/yaml",
-        }
-        if ext in overrides:
-            return overrides[ext]
-    mime_type, _ = mimetypes.guess_type(name, strict=False)
+    mime_type = _MIME_BY_EXT.get(os.path.splitext(name)[1])
+    if mime_type:
+        return mime_type
+    if ":" in name:
+        mime_type, _ = mimetypes.guess_type(name, strict=False)
+        return mime_type or "application/octet-stream"
+    # mimetypes only looks at the trailing suffixes (.tar.gz, .tgz, ...), so
+    # the answer is cached per suffix chain rather than per file name.
+    base = os.path.basename(name).lstrip(".")
+    dot = base.find(".")
+    return _guess_mime_type_by_suffix(base[dot:] if dot >= 0 else "")
+
+
+@functools.lru_cache(maxsize=512)
+def _guess_mime_type_by_suffix(suffix: str) -> str:
+    mime_type, _ = mimetypes.guess_type("f" + suffix, strict=False)
     return mime_type or "application/octet-stream"
 
+_BULK_TEXT_FIELDS = ("content", "stdout", "stderr", "skill_md")
+_BULK_LIST_FIELDS = ("entries", "files")
+
+
+def _truncate_tool_result(result: Any, max_chars: int, max_entries: int) -> Any:
+    if not isinstance(result, dict):
+        return result
+    trimmed: dict[str, Any] | None = None
+    for key in _BULK_TEXT_FIELDS:
+        value = result.get(key)
+        if isinstance(value, str) and len(value) > max_chars:
+            trimmed = trimmed if trimmed is not None else dict(result)
+            # Keep both ends: errors and summaries usually sit at the tail of command output.
+            head = max_chars * 3 // 4
+            tail = max_chars - head
+            trimmed[key] = f"{value[:head]}\n...[truncated {len(value) - max_chars} chars]...\n{value[-tail:]}"
+    for key in _BULK_LIST_FIELDS:
+        value = result.get(key)
+        if isinstance(value, list) and len(value) > max_entries:
+            trimmed = trimmed if trimmed is not None else dict(result)
+            trimmed[key] = value[:max_entries]
+            trimmed[f"{key}_truncated"] = len(value) - max_entries
+    return trimmed if trimmed is not None else result
+
+
+def _elide_tool_result(name: str, result: Any) -> dict[str, Any]:
+    summary: dict[str, Any] = {}
+    if isinstance(result, dict):
+        for key, value in result.items():
+            if key in _BULK_TEXT_FIELDS and isinstance(value, str):
+                summary[key] = f"<{len(value)} chars>"
+            elif key in _BULK_LIST_FIELDS and isinstance(value, list):
+                summary[key] = f"<{len(value)} items>"
+            elif isinstance(value, (str, int, float, bool)) or value is None:
+                summary[key] = _shorten_text(value, 200) if isinstance(value, str) else value
+    return {"elided": True, "name": name, "summary": summary}
+
+
+_TOON_MAX_DEPTH = 3
+_TOON_PLAIN_RE = re.compile(r"[^\s|:\"\\{}\[\],#-][^|:\"\\\n\r\t]*")
+_TOON_LITERAL_RE = re.compile(r"true|false|null|[\d.+-][\d.eE+-]*")
+
+
+def _toon_scalar(value: Any) -> str:
+    # Strings that could be misread as a delimiter, number or literal are quoted.
+    if isinstance(value, str) and (
+        value != value.strip() or not _TOON_PLAIN_RE.fullmatch(value) or _TOON_LITERAL_RE.fullmatch(value)
+    ):
+        return _json_dumps(value)
+    return value if isinstance(value, str) else _json_dumps(value)
+
+
+def _toon_lines(value: Any, indent: int, depth: int, out: list[str]) -> bool:
+    pad = " " * indent
+    if depth > _TOON_MAX_DEPTH or not isinstance(value, dict):
+        return False
+    for key, item in value.items():
+        if not isinstance(key, str) or not _TOON_PLAIN_RE.fullmatch(key):
+            return False
+        if isinstance(item, dict):
+            out.append(f"{pad}{key}:")
+            if not _toon_lines(item, indent + 2, depth + 1, out):
+                return False
+        elif isinstance(item, list):
+            if not item:
+                out.append(f"{pad}{key}[0]:")
+                continue
+            if all(not isinstance(v, (dict, list)) for v in item):
+                out.append(f"{pad}{key}[{len(item)}]: " + "|".join(_toon_scalar(v) for v in item))
+                continue
+            # Only flat rows sharing one key set are tabulated; anything else stays JSON.
+            if not all(isinstance(v, dict) for v in item):
+                return False
+            fields = list(item[0])
+            if any(list(v) != fields for v in item) or not all(
+                isinstance(f, str) and _TOON_PLAIN_RE.fullmatch(f) for f in fields
+            ):
+                return False
+            if any(isinstance(c, (dict, list)) for v in item for c in v.values()):
+                return False
+            out.append(f"{pad}{key}[{len(item)}]{{{','.join(fields)}}}:")
+            out.extend(f"{pad}  " + "|".join(_toon_scalar(c) for c in v.values()) for v in item)
+        else:
+            out.append(f"{pad}{key}: {_toon_scalar(item)}")
+    return True
+
+
+def _format_tool_result(name: str, result: Any) -> str:
+    # Tabular key/row text for the JSON protocol's TOOL_RESULT turns; it repeats
+    # no keys or punctuation per row. Irregular results are sent as JSON.
+    out: list[str] = []
+    if _toon_lines(result, 2, 0, out):
+        return f"name: {name}\nresult:\n" + "\n".join(out)
+    return _json_dumps({"name": name, "result": result})
+
+
 def _safe_join(root: str, relative_path: str) -> str:
     root_abs = os.path.abspath(root)
     joined = os.path.abspath(os.path.join(root_abs, relative_path))
-    if os.path.commonpath([root_abs, joined]) != root_abs:
+    if joined == root_abs:
+        return joined
+    prefix = root_abs if root_abs.endswith(os.sep) else root_abs + os.sep
+    if not joined.startswith(prefix):
         raise ValueError("path is outside root")
     return joined
 
+# For fixed subdirectories and skill names under the long-lived absolute roots;
+# raising results are not cached, so validation still runs on every bad input.
+@functools.lru_cache(maxsize=1024)
+def _safe_join_cached(root: str, relative_path: str) -> str:
+    return _safe_join(root, relative_path)
+
+
+_READ_TEXT_CHUNK_BYTES = 1 << 20
+
+
 def _read_text(path: str, max_chars: int = 12000) -> str:
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.read(max_chars)
+    if max_chars is None or max_chars < 0:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            return f.read()
+    # UTF-8 needs at most 4 bytes per char, so small limits take one raw read;
+    # large ones read capped chunks until enough characters are decoded.
+    # Newlines are normalised the same way text mode would.
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    parts: list[str] = []
+    have = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while have < max_chars:
+            chunk = os.read(fd, min((max_chars - have) * 4, _READ_TEXT_CHUNK_BYTES))
+            piece = decoder.decode(chunk, final=not chunk)
+            if piece:
+                # "\r\n" becomes one character, including a pair split across chunks.
+                have += len(piece) - piece.count("\r\n")
+                if piece[0] == "\n" and parts and parts[-1][-1] == "\r":
+                    have -= 1
+                parts.append(piece)
+            if not chunk:
+                break
+    finally:
+        os.close(fd)
+    text = "".join(parts)
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text[:max_chars]
+
+
+def _scandir_recursive(path: str, rel_prefix: str, depth: int, max_depth: int) -> Iterator[dict[str, Any]]:
+    try:
+        with os.scandir(path) as it:
+            dirs: list[os.DirEntry[str]] = []
+            files: list[os.DirEntry[str]] = []
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                (dirs if is_dir else files).append(entry)
+    except OSError:
+        return
+    dirs.sort(key=lambda e: e.name)
+    files.sort(key=lambda e: e.name)
+    for entry in dirs:
+        yield {"type": "dir", "path": entry.path, "relative_path": rel_prefix + entry.name}
+    for entry in files:
+        yield {"type": "file", "path": entry.path, "relative_path": rel_prefix + entry.name}
+    if depth >= max_depth:
+        return
+    for entry in dirs:
+        if entry.is_symlink():
+            continue
+        yield from _scandir_recursive(entry.path, rel_prefix + entry.name + os.sep, depth + 1, max_depth)
 
 
 def _list_dir(root: str, max_depth: int = 2) -> list[dict[str, Any]]:
     root_abs = os.path.abspath(root)
-    entries: list[dict[str, Any]] = []
-    root_depth = root_abs.count(os.sep)
-    for current_root, dirs, files in os.walk(root_abs):
-        depth = current_root.count(os.sep) - root_depth
-        if depth > max_depth:
-            dirs[:] = []
+    if max_depth < 0:
+        return []
+    return list(_scandir_recursive(root_abs, "", 0, max_depth))
+
+
+def _list_file_paths(root: str, max_depth: int = 2) -> list[str]:
+    # Relative paths of the files _list_dir would report, in the same order,
+    # without building a record per entry.
+    out: list[str] = []
+    if max_depth >= 0:
+        _collect_file_paths(os.path.abspath(root), "", 0, max_depth, out)
+    return out
+
+
+def _collect_file_paths(path: str, rel_prefix: str, depth: int, max_depth: int, out: list[str]) -> None:
+    try:
+        with os.scandir(path) as it:
+            dirs: list[os.DirEntry[str]] = []
+            files: list[str] = []
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    files.append(entry.name)
+    except OSError:
+        return
+    files.sort()
+    out.extend(rel_prefix + name for name in files)
+    if depth >= max_depth:
+        return
+    dirs.sort(key=lambda e: e.name)
+    for entry in dirs:
+        if entry.is_symlink():
             continue
-        for name in sorted(dirs):
-            entries.append(
-                {
-                    "type": "dir",
-                    "path": os.path.join(current_root, name),
-                    "relative_path": os.path.relpath(os.path.join(current_root, name), root_abs),
-                }
-            )
-        for name in sorted(files):
-            entries.append(
-                {
-                    "type": "file",
-                    "path": os.path.join(current_root, name),
-                    "relative_path": os.path.relpath(os.path.join(current_root, name), root_abs),
-                }
-            )
-    return entries
+        _collect_file_paths(entry.path, rel_prefix + entry.name + os.sep, depth + 1, max_depth, out)
+
+
+def _has_any_file(root: str, max_depth: int = 2) -> bool:
+    # Same walk as _list_file_paths, stopping at the first file found.
+    if max_depth < 0:
+        return False
+    stack = [(os.path.abspath(root), 0)]
+    while stack:
+        path, depth = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        return True
+                    if depth < max_depth and not entry.is_symlink():
+                        stack.append((entry.path, depth + 1))
+        except OSError:
+            continue
+    return False
+
+
+_FRONTMATTER_CLOSE_RE = re.compile(r"^[^\S\n]*---[^\S\n]*$", re.MULTILINE)
 
 
 def _parse_frontmatter(content: str) -> dict[str, str]:
+    # Only the block up to the closing "---" is split into lines, not the whole
+    # SKILL.md body; the loop below still stops at any earlier "---" line.
+    first_nl = content.find("\n")
+    if first_nl >= 0:
+        close = _FRONTMATTER_CLOSE_RE.search(content, first_nl + 1)
+        if close is not None:
+            content = content[: close.start()]
     lines = content.splitlines()
     if not lines or lines[0].strip() != "---":
         return {}
     data: dict[str, str] = {}
     for line in lines[1:]:
-        if line.strip() == "---":
-            break
-        if ":" not in line:
+        key, sep, value = line.partition(":")
+        if not sep:
+            if line.strip() == "---":
+                break
             continue
-        key, value = line.split(":", 1)
         key = key.strip()
-        value = value.strip().strip('"').strip("'")
         if key:
-            data[key] = value
+            data[key] = value.strip().strip('"').strip("'")
     return data
 
+
+_JSON_SCAN_RE = re.compile(r'[{}"\\]')
+
+
 def _extract_first_json_object(text: str) -> str | None:
     if not text:
         return None
@@ -134,58 +444,193 @@ def _extract_first_json_object(text: str) -> str | None:
     start = s.find("{")
     if start < 0:
         return None
+    # Well-formed objects are resolved by the C scanner in one call; the manual
+    # brace matcher below only runs for balanced-but-invalid candidates.
+    try:
+        _, end = _JSON_DECODER.raw_decode(s, start)
+        return s[start:end]
+    except ValueError:
+        pass
     depth = 0
     in_str = False
-    escape = False
-    for i in range(start, len(s)):
+    escaped_at = -1
+    # Only quotes, backslashes and braces change state, so the scan jumps between them.
+    for m in _JSON_SCAN_RE.finditer(s, start):
+        i = m.start()
+        if i == escaped_at:
+            continue
         ch = s[i]
         if in_str:
-            if escape:
-                escape = False
-                continue
             if ch == "\\":
-                escape = True
-                continue
-            if ch == '"':
+                escaped_at = i + 1
+            elif ch == '"':
                 in_str = False
             continue
         if ch == '"':
             in_str = True
-            continue
-        if ch == "{":
+        elif ch == "{":
             depth += 1
-            continue
-        if ch == "}":
+        elif ch == "}":
             depth -= 1
             if depth == 0:
                 return s[start : i + 1]
     return None
 
+
+_PROTOCOL_STATES = {"tool": "json_tool", "final": "json_final"}
+
+
+# Streaming counterpart of running _extract_first_json_object over the whole
+# buffer after every delta: the brace scan resumes where the previous feed
+# stopped, so each character is inspected once.
+class _JsonSniffer:
+    def __init__(self) -> None:
+        self.state = "text"
+        # Text the last feed appended to the stripped running buffer.
+        self.visible = ""
+        # First complete JSON object in the reply and its decoded value, once seen.
+        self.json_text: str | None = None
+        self.json_obj: Any = None
+        self._buf = io.StringIO()
+        self._size = 0
+        self._lstart = -1
+        self._head = ""
+        self._ws = ""
+        self._fenced = False
+        self._fence_checked = False
+        # Fences found so far and where the next search resumes.
+        self._fences = 0
+        self._fence_scan = 0
+        self._done = False
+        self._start = -1
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+
+    @property
+    def text(self) -> str:
+        return self._buf.getvalue()
+
+    def feed(self, chunk: str) -> str:
+        self.visible = ""
+        if not chunk:
+            return self.state
+        base = self._size
+        self._buf.write(chunk)
+        self._size += len(chunk)
+        tail = chunk.rstrip()
+        if tail:
+            if self._lstart < 0:
+                lead = len(chunk) - len(chunk.lstrip())
+                self._lstart = base + lead
+                self.visible = tail[lead:]
+            else:
+                self.visible = self._ws + tail
+            self._ws = chunk[len(tail) :]
+        elif self._lstart >= 0:
+            self._ws += chunk
+        if self._lstart < 0:
+            return self.state
+        if not self._fence_checked:
+            self._head += self.visible
+            if len(self._head) >= 3:
+                self._fenced = self._head.startswith("```")
+                self._fence_checked = True
+        if self._fenced:
+            self.state = self._fenced_state()
+        elif not self._done:
+            self.state = self._scan(chunk, base)
+        return self.state
+
+    def _fenced_state(self) -> str:
+        text = self.text
+        if self._fences < 2:
+            pos = self._fence_scan
+            while True:
+                i = text.find("```", pos)
+                if i < 0:
+                    break
+                self._fences += 1
+                pos = i + 3
+            self._fence_scan = max(pos, len(text) - 2)
+        if self._fences < 2:
+            return "unknown"
+        candidate = _extract_first_json_object(text)
+        if not candidate:
+            self.json_text = self.json_obj = None
+            return "text"
+        return self._classify(candidate)
+
+    def _classify(self, json_text: str) -> str:
+        self.json_text = json_text
+        try:
+            self.json_obj = _json_loads(json_text)
+        except Exception:
+            self.json_obj = None
+        return _protocol_state(self.json_obj)
+
+    def _scan(self, chunk: str, base: int) -> str:
+        begin = 0
+        if self._start < 0:
+            begin = chunk.find("{")
+            if begin < 0:
+                return "text"
+            self._start = base + begin
+        depth, in_str = self._depth, self._in_str
+        # A backslash ending the previous chunk escapes this chunk's first char.
+        escaped_at = begin if self._escape else -1
+        for m in _JSON_SCAN_RE.finditer(chunk, begin):
+            i = m.start()
+            if i == escaped_at:
+                continue
+            ch = chunk[i]
+            if in_str:
+                if ch == "\\":
+                    escaped_at = i + 1
+                elif ch == '"':
+                    in_str = False
+                continue
+            if ch == '"':
+                in_str = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    # The first complete object decides the state for good.
+                    self._done = True
+                    return self._classify(self.text[self._start : base + i + 1])
+        self._depth, self._in_str, self._escape = depth, in_str, escaped_at == len(chunk)
+        return "unknown" if self._start == self._lstart else "text"
+
+
+def _protocol_state(obj: Any) -> str:
+    if not isinstance(obj, dict):
+        return "text"
+    t = obj.get("type")
+    return _PROTOCOL_STATES.get(t, "text") if isinstance(t, str) else "text"
+
+
 def _normalize_small_reply(text: str) -> str:
     if not isinstance(text, str):
         return ""
-    t = text.strip().lower()
-    t = re.sub(r"\s+", "", t)
-    t = re.sub(r"[。．\.，,！!？\?；;：:\-—_~`'\"]+", "", t)
-    return t
+    return _REPLY_STRIP_RE.sub("", text.lower())
 
 def _is_allow_reply(text: str) -> bool:
     t = _normalize_small_reply(text)
     if not t:
         return False
-    if any(x in t for x in ("不允许", "不同意", "不可以", "不要", "拒绝", "取消")):
+    if _DENY_REPLY_RE.search(t):
         return False
-    if t in {"允许", "同意", "可以", "好的", "好", "ok", "okay", "yes", "y", "sure"}:
+    if t in _ALLOW_REPLY_WORDS:
         return True
-    if "允许" in t or "同意" in t:
-        return True
-    return False
+    return _ALLOW_REPLY_RE.search(t) is not None
 
 def _is_deny_reply(text: str) -> bool:
     t = _normalize_small_reply(text)
     if not t:
         return False
-    return any(x in t for x in ("不允许", "不同意", "不可以", "不要", "拒绝", "取消"))
+    return _DENY_REPLY_RE.search(t) is not None
 
 def _coerce_content_item_to_dict(item: Any) -> dict[str, Any] | None:
     if item is None:
@@ -220,6 +665,12 @@ def _split_message_content(content: Any) -> tuple[str, list[dict[str, Any]]]:
         text_parts: list[str] = []
         nontext_parts: list[dict[str, Any]] = []
         for item in content:
+            if not isinstance(item, dict) and getattr(item, "type", None) == "text":
+                # Text parts only need .data; skip model_dump() and its try/except ladder.
+                data = getattr(item, "data", None)
+                if isinstance(data, str) and data:
+                    text_parts.append(data)
+                continue
             item_dict = _coerce_content_item_to_dict(item)
             if not item_dict:
                 continue
@@ -234,17 +685,17 @@ def _split_message_content(content: Any) -> tuple[str, list[dict[str, Any]]]:
     return "", [{"type": "unknown", "value": str(content)}]
 
 def _extract_tool_calls(response: Any) -> list[Any]:
-    message = _safe_get(response, "message") or response
-    tool_calls = _safe_get(message, "tool_calls") or []
+    message = _get_field(response, "message") or response
+    tool_calls = _get_field(message, "tool_calls") or []
     if isinstance(tool_calls, list):
         return tool_calls
     return []
 
 def _parse_tool_call(tool_call: Any) -> tuple[str | None, str | None, dict[str, Any]]:
-    call_id = _safe_get(tool_call, "id")
-    function_info = _safe_get(tool_call, "function") or {}
-    name = _safe_get(function_info, "name")
-    raw_args = _safe_get(function_info, "arguments") or "{}"
+    call_id = _get_field(tool_call, "id")
+    function_info = _get_field(tool_call, "function") or {}
+    name = _get_field(function_info, "name")
+    raw_args = _get_field(function_info, "arguments") or "{}"
     if isinstance(raw_args, dict):
         return call_id, name, raw_args
     if not isinstance(raw_args, str):
@@ -266,7 +717,7 @@ def _parse_tool_call(tool_call: Any) -> tuple[str | None, str | None, dict[str,
             pass
         return call_id, name, {}
     try:
-        parsed = json.loads(raw_args)
+        parsed = _json_loads(raw_args)
         return call_id, name, parsed if isinstance(parsed, dict) else {}
     except Exception as e:
         try:
@@ -289,16 +740,23 @@ def _parse_tool_call(tool_call: Any) -> tuple[str | None, str | None, dict[str,
 
 PromptToolT = TypeVar("PromptToolT")
 
-_PROMPT_MESSAGE_TOOLS: list[Any] | None = None
-_PROMPT_MESSAGE_TOOLS_CACHE_KEY: tuple[int, int] | None = None
-
+# (schema content digest, tool class) -> built tools; keyed on content, since
+# id() of a schema list is reused once the list is collected.
+_PROMPT_MESSAGE_TOOLS_CACHE: OrderedDict[tuple[bytes, type], list[Any]] = OrderedDict()
+_PROMPT_MESSAGE_TOOLS_CACHE_MAX = 8
 
-def _build_prompt_message_tools(tool_schemas: list[dict[str, Any]], tool_cls: type[PromptToolT]) -> list[PromptToolT]:
-    global _PROMPT_MESSAGE_TOOLS, _PROMPT_MESSAGE_TOOLS_CACHE_KEY
 
-    cache_key = (id(tool_schemas), id(tool_cls))
-    if _PROMPT_MESSAGE_TOOLS is not None and _PROMPT_MESSAGE_TOOLS_CACHE_KEY == cache_key:
-        return _PROMPT_MESSAGE_TOOLS  # type: ignore[return-value]
+def _build_prompt_message_tools(tool_schemas: Sequence[dict[str, Any]], tool_cls: type[PromptToolT]) -> list[PromptToolT]:
+    try:
+        encoded = json.dumps(list(tool_schemas), sort_keys=True, ensure_ascii=False, default=str)
+        cache_key: tuple[bytes, type] | None = (_content_digest(encoded.encode("utf-8")).digest(), tool_cls)
+    except Exception:
+        cache_key = None
+    if cache_key is not None:
+        cached = _PROMPT_MESSAGE_TOOLS_CACHE.get(cache_key)
+        if cached is not None:
+            _PROMPT_MESSAGE_TOOLS_CACHE.move_to_end(cache_key)
+            return cached  # type: ignore[return-value]
 
     tools: list[PromptToolT] = []
     for schema in tool_schemas:
@@ -314,8 +772,8 @@ def _build_prompt_message_tools(tool_schemas: list[dict[str, Any]], tool_cls: ty
             continue
         if not isinstance(description, str):
             description = ""
-        if not isinstance(parameters, dict):
-            parameters = {}
+        # Defaults go on a copy so the caller's schemas, and the cache key, stay as given.
+        parameters = dict(parameters) if isinstance(parameters, dict) else {}
         if "type" not in parameters:
             parameters["type"] = "object"
         if "properties" not in parameters or not isinstance(parameters.get("properties"), dict):
@@ -324,8 +782,10 @@ def _build_prompt_message_tools(tool_schemas: list[dict[str, Any]], tool_cls: ty
             parameters["required"] = []
         tools.append(tool_cls(name=name.strip(), description=description, parameters=parameters))
 
-    _PROMPT_MESSAGE_TOOLS = tools  # type: ignore[assignment]
-    _PROMPT_MESSAGE_TOOLS_CACHE_KEY = cache_key
+    if cache_key is not None:
+        _PROMPT_MESSAGE_TOOLS_CACHE[cache_key] = tools
+        while len(_PROMPT_MESSAGE_TOOLS_CACHE) > _PROMPT_MESSAGE_TOOLS_CACHE_MAX:
+            _PROMPT_MESSAGE_TOOLS_CACHE.popitem(last=False)
     return tools
 
 def _extract_url_and_name(file_item: Any) -> tuple[str | None, str | None]:
@@ -350,12 +810,125 @@ def _infer_ext_from_url(url: str) -> str:
 def _safe_filename(preferred_name: str | None, fallback_ext: str = "") -> str:
     if preferred_name:
         base = os.path.basename(str(preferred_name))
-        base = re.sub(r"[<>:\"/\\\\|?*]+", "_", base).strip()
+        base = _UNSAFE_FILENAME_CHARS_RE.sub("_", base).strip()
         if base:
             return base
     return f"{uuid.uuid4().hex}{fallback_ext}"
 
-def _download_file_content(url: str, timeout: int = 30) -> bytes:
-    req = Request(url, headers={"User-Agent": "dify-plugin-skill/1.0"})
-    with urlopen(req, timeout=timeout) as resp:
-        return resp.read()
+# Fingerprints only de-duplicate files, so a fast non-cryptographic-strength digest will do.
+_content_digest = functools.partial(hashlib.blake2b, digest_size=16)
+
+
+def _decode_base64_to_file(data: str, path: str) -> str:
+    # Decode clean base64 slice by slice so the raw bytes never sit in memory
+    # whole; anything strict decoding rejects gets the lenient one-shot decode.
+    digest = _content_digest()
+    try:
+        with open(path, "wb") as f:
+            for i in range(0, len(data), _BASE64_CHUNK_CHARS):
+                raw = binascii.a2b_base64(data[i : i + _BASE64_CHUNK_CHARS], strict_mode=True)
+                digest.update(raw)
+                f.write(raw)
+        return digest.hexdigest()
+    except ValueError:
+        pass
+    raw = base64.b64decode(data, validate=False)
+    with open(path, "wb") as f:
+        f.write(raw)
+    return _content_digest(raw).hexdigest()
+
+
+_DOWNLOAD_HEADERS = {"User-Agent": "dify-plugin-skill/1.0"}
+_DOWNLOAD_CHUNK_BYTES = 1 << 20
+_HTTP_SESSION: Any = None
+_HTTP_SESSION_LOCK = threading.Lock()
+
+# (url, target path) -> (st_mtime_ns, st_size) of the file that download wrote;
+# a resent upload whose file is still untouched on disk is not fetched again.
+_DOWNLOADED_FILES: OrderedDict[tuple[str, str], tuple[int, int]] = OrderedDict()
+_DOWNLOADED_FILES_MAX = 256
+_DOWNLOADED_FILES_LOCK = threading.Lock()
+
+
+def _http_session() -> Any:
+    # One pooled session per process, so repeated downloads from the same
+    # file server reuse TCP/TLS connections.
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        with _HTTP_SESSION_LOCK:
+            if _HTTP_SESSION is None:
+                session = _requests.Session()
+                adapter = _requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(_DOWNLOAD_HEADERS)
+                _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+
+def _download_file_to_path(url: str, path: str, timeout: int = 30) -> int:
+    key = (url, path)
+    with _DOWNLOADED_FILES_LOCK:
+        stamp = _DOWNLOADED_FILES.get(key)
+    if stamp is not None:
+        try:
+            st = os.stat(path)
+            if (st.st_mtime_ns, st.st_size) == stamp:
+                return st.st_size
+        except OSError:
+            pass
+    # Streams into a sibling .part file and renames it into place, so a failed
+    # download never leaves a truncated upload behind.
+    part_path = path + ".part"
+    try:
+        with open(part_path, "wb") as f:
+            if _requests is not None:
+                with _http_session().get(url, timeout=timeout, stream=True) as resp:
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(_DOWNLOAD_CHUNK_BYTES):
+                        f.write(chunk)
+            else:
+                req = Request(url, headers=_DOWNLOAD_HEADERS)
+                with urlopen(req, timeout=timeout) as resp:
+                    shutil.copyfileobj(resp, f, _DOWNLOAD_CHUNK_BYTES)
+            size = f.tell()
+        os.replace(part_path, path)
+    except BaseException:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        raise
+    try:
+        st = os.stat(path)
+    except OSError:
+        return size
+    with _DOWNLOADED_FILES_LOCK:
+        _DOWNLOADED_FILES[key] = (st.st_mtime_ns, st.st_size)
+        _DOWNLOADED_FILES.move_to_end(key)
+        while len(_DOWNLOADED_FILES) > _DOWNLOADED_FILES_MAX:
+            _DOWNLOADED_FILES.popitem(last=False)
+    return size
+
+
+def _download_files(targets: list[tuple[str, str]], timeout: int = 30) -> Iterator[int | Exception]:
+    # Downloads (url, path) pairs concurrently; results come back in input
+    # order as the byte count written, or the exception for a failed URL.
+    if len(targets) < 2:
+        for url, path in targets:
+            try:
+                yield _download_file_to_path(url, path, timeout=timeout)
+            except Exception as e:
+                yield e
+        return
+    with ThreadPoolExecutor(max_workers=min(8, len(targets))) as pool:
+        futures = [pool.submit(_download_file_to_path, url, path, timeout) for url, path in targets]
+        try:
+            for future in futures:
+                try:
+                    yield future.result()
+                except Exception as e:
+                    yield e
+        finally:
+            for future in futures:
+                future.cancel()